@@ -8,13 +8,13 @@ __license__ = 'GPL v3'
 __copyright__ = '2013, Greg Riker <griker@hotmail.com>'
 __docformat__ = 'restructuredtext en'
 
-import atexit, os, sys, threading
+import atexit, json, os, sys, threading
 
 from functools import partial
 from lxml import etree, html
 from zipfile import ZipFile
 
-from PyQt4.Qt import (Qt, QApplication, QCursor, QIcon, QMenu, QTimer, QUrl,
+from PyQt4.Qt import (Qt, QApplication, QCursor, QIcon, QMenu, QThread, QTimer, QUrl,
                       pyqtSignal)
 
 from calibre.constants import DEBUG
@@ -28,13 +28,16 @@ from calibre.gui2.device import device_signals
 from calibre.gui2.dialogs.message_box import MessageBox
 from calibre.library import current_library_name
 from calibre.utils.config import config_dir
+from calibre.utils.filenames import atomic_rename
 
 from calibre_plugins.marvin_manager import MarvinManagerPlugin
 from calibre_plugins.marvin_manager.annotations_db import AnnotationsDB
 from calibre_plugins.marvin_manager.book_status import BookStatusDialog
 from calibre_plugins.marvin_manager.common_utils import (AbortRequestException,
-    CompileUI, IndexLibrary, Logger, MyBlockingBusy, ProgressBar, Struct,
-    get_icon, set_plugin_icon_resources, updateCalibreGUIView)
+    CompileUI, IndexLibrary, Logger, MyBlockingBusy, PreHashLibrary, ProgressBar, Struct,
+    get_epub_paths, get_icon, save_epub_hashes, set_plugin_icon_resources,
+    updateCalibreGUIView)
+from calibre_plugins.marvin_manager.hash_cache import HashCache
 import calibre_plugins.marvin_manager.config as cfg
 #from calibre_plugins.marvin_manager.dropbox import PullDropboxUpdates
 
@@ -50,6 +53,10 @@ class MarvinManagerAction(InterfaceAction, Logger):
     icon = PLUGIN_ICONS[0]
     minimum_ios_driver_version = (1, 3, 1)
     name = 'Marvin XD'
+
+    # Background library hashing delays (ms)
+    PREHASH_DELAY = 5000
+    PREHASH_RETRY_DELAY = 30000
     prefs = cfg.plugin_prefs
     verbose = prefs.get('debug_plugin', False)
 
@@ -59,6 +66,7 @@ class MarvinManagerAction(InterfaceAction, Logger):
     action_add_menu = True
     action_menu_clone_qaction = True
 
+    library_db_changed = pyqtSignal(object, object)
     marvin_device_status_changed = pyqtSignal(str)
     plugin_device_connection_changed = pyqtSignal(object)
 
@@ -90,6 +98,13 @@ class MarvinManagerAction(InterfaceAction, Logger):
                 if self.ios.exists(rhc):
                     self.ios.remove(rhc)
                     self._log("remote hash cache at %s deleted" % rhc)
+
+                hash_cache = HashCache(self.ios, self.resources_path, remote_cache_folder)
+                hash_cache.connect()
+                hash_cache.remove_remote()
+                hash_cache.clear()
+                hash_cache.close()
+                self._log("hash cache segments and local hash cache deleted")
             elif action == 'Delete calibre hashes':
                 self.gui.current_db.delete_all_custom_book_data('epub_hash')
                 self._log("cached epub hashes deleted")
@@ -154,22 +169,28 @@ class MarvinManagerAction(InterfaceAction, Logger):
         # General initialization, occurs when calibre launches
         self.book_status_dialog = None
         self.blocking_busy = MyBlockingBusy(self.gui, "Updating Marvin Library…", size=50)
+        self.busy_window = None
         self.connected_device = None
         self.current_location = 'library'
         self.dropbox_processed = False
         self.ios = None
         self.installed_books = None
+        self.installed_books_main_db_checksum = None
+        self.installed_books_row_state = None
+        self.installed_books_stale_cids = set()
         self.marvin_content_updated = False
         self.menus_lock = threading.RLock()
+        self.subscribed_library = None
         self.sync_lock = threading.RLock()
         self.indexed_library = None
         self.library_indexed = False
         self.library_last_modified = None
+        self.library_prehasher = None
+        self.library_db_changed.connect(self.library_db_event)
         self.marvin_connected = False
         self.resources_path = os.path.join(config_dir, 'plugins', "%s_resources" % self.name.replace(' ', '_'))
         if not os.path.exists(self.resources_path):
             os.makedirs(self.resources_path)
-        self.virtual_library = None
 
         # Build a current opts object
         self.opts = self.init_options()
@@ -346,25 +367,34 @@ class MarvinManagerAction(InterfaceAction, Logger):
         # Subscribe to device connection events
         device_signals.device_connection_changed.connect(self.on_device_connection_changed)
 
+        # Subscribe to library add/delete/metadata events
+        self._subscribe_to_library(self.gui.current_db)
+
+        # Warm the library hash map once calibre settles
+        QTimer.singleShot(self.PREHASH_DELAY, self.start_library_prehash)
+
     def launch_library_scanner(self):
         '''
         Call IndexLibrary() to index current_db by uuid, title
         Need a test to see if db has been updated since last run. Until then,
         optimization disabled.
-        After indexing, self.library_scanner.uuid_map and .title_map are populated
+        After indexing, self.library_scanner.uuid_map and .title_author_map are populated
+        The index covers the whole library, the current virtual library is applied
+        as a filter
         '''
 
+        # Keep whatever the background hasher has finished
+        self._stop_library_prehash(save=True)
+
         mdb = self.gui.library_view.model().db
         current_vl = mdb.data.get_base_restriction_name()
 
-        if (self.library_last_modified == self.gui.current_db.last_modified() and
-                self.indexed_library is self.gui.current_db and
-                self.library_indexed and
-                self.library_scanner is not None and
-                self.virtual_library == current_vl):
-            self._log_location("library index current for virtual library %s" % repr(current_vl))
+        if self._library_index_current():
+            self._log_location("library index current")
+        elif self._load_library_index():
+            self._log_location("library index restored")
         else:
-            self._log_location("updating library index for virtual library %s" % repr(current_vl))
+            self._log_location("updating library index")
             self.library_scanner = IndexLibrary(self)
 
             if False:
@@ -380,13 +410,72 @@ class MarvinManagerAction(InterfaceAction, Logger):
                     Application.processEvents()
                 self.library_index_complete()
 
+        self._log_location("virtual library %s" % repr(current_vl))
+        if self.library_scanner.active_virtual_library != current_vl:
+            # Calibre matches in the saved installed_books are for another virtual library
+            self.installed_books = None
+        self.library_scanner.set_virtual_library(current_vl)
+
+        # Books edited since the hash_map was built are rehashed by the dialog
+        if (self.library_scanner.hash_map is not None and
+                self.library_scanner.unhashed_books()):
+            self.library_scanner.hash_map = None
+
     # subclass override
     def library_changed(self, db):
         self._log_location(current_library_name())
+        self._stop_library_prehash(save=False)
+        self._save_library_index()
         self.indexed_library = None
         self.library_indexed = False
         self.library_scanner = None
         self.library_last_modified = None
+        self._subscribe_to_library(db)
+
+        # Hash the new library in the background
+        QTimer.singleShot(self.PREHASH_DELAY, self.start_library_prehash)
+
+    def library_db_event(self, event, ids):
+        '''
+        Patch the library index as books are added, deleted or edited,
+        rather than rebuilding it when the library's last_modified changes.
+        Anything we can't patch invalidates the index for a full rebuild.
+        Other per-book events (covers, formats) leave the index as is, but
+        still stale the installed_books matched to those books.
+        '''
+        if not (self.library_indexed and
+                self.library_scanner is not None and
+                self.indexed_library is self.gui.current_db):
+            return
+        self._log_location("%s: %s" % (event, ids))
+
+        if event in ['add', 'delete', 'metadata']:
+            try:
+                if event == 'delete':
+                    self.library_scanner.remove_books(ids)
+                else:
+                    self.library_scanner.update_books(ids)
+                patched = True
+            except:
+                import traceback
+                self._log(traceback.format_exc())
+                patched = False
+
+            if not patched:
+                self._log("library index invalidated")
+                self._stop_library_prehash(save=False)
+                self.library_indexed = False
+                return
+
+            self.library_last_modified = self.gui.current_db.last_modified()
+
+        if self.book_status_dialog is None:
+            # The dialog rebuilds the saved installed_books matched to these cids.
+            # While it is open, it keeps them current itself.
+            self.installed_books_stale_cids.update(ids)
+
+            # Hash new or changed epubs in the background
+            QTimer.singleShot(self.PREHASH_DELAY, self.start_library_prehash)
 
     def library_index_complete(self):
         self._log_location()
@@ -394,19 +483,37 @@ class MarvinManagerAction(InterfaceAction, Logger):
         self.indexed_library = self.gui.current_db
         self.library_last_modified = self.gui.current_db.last_modified()
 
-        # Save the virtual library name we ran the indexing against
-        mdb = self.gui.library_view.model().db
-        current_vl = mdb.data.get_base_restriction_name()
-        self.virtual_library = self.library_scanner.active_virtual_library = current_vl
-
-        # Reset the hash_map in case we had a prior instance from a different vl
-        self.library_scanner.hash_map = None
-
         # Reset self.installed_books
         self.installed_books = None
 
         self._busy_panel_teardown()
 
+    def library_prehash_complete(self):
+        '''
+        PreHashLibrary finished. Save its hashes, warm the library hash_map
+        '''
+        prehasher = self.sender()
+        if prehasher is not self.library_prehasher:
+            # Superseded by a library change or the Marvin window opening
+            return
+
+        self._log_location("%d epubs left to save" % len(prehasher.hashes))
+        self.library_prehasher = None
+        self._save_library_prehash(prehasher)
+        if self.library_scanner is prehasher.library_scanner:
+            self.library_scanner.build_hash_map()
+            self._save_library_index()
+
+            # Books changed while we were hashing
+            if self.library_scanner.unhashed_books():
+                QTimer.singleShot(self.PREHASH_DELAY, self.start_library_prehash)
+
+    def library_prehash_batch(self, hashes):
+        '''
+        PreHashLibrary has hashed a batch, save it to the library it was computed for
+        '''
+        self._save_library_prehash(self.sender(), hashes)
+
     # subclass override
     def location_selected(self, loc):
         self._log_location(loc)
@@ -776,6 +883,13 @@ class MarvinManagerAction(InterfaceAction, Logger):
 
             # Keep a copy of installed_books in case user reopens w/o disconnect
             self.installed_books = self.book_status_dialog.installed_books
+            self.installed_books_main_db_checksum = self.book_status_dialog.main_db_checksum
+            self.installed_books_row_state = self.book_status_dialog.installed_books_row_state
+            if self.installed_books is not None:
+                self.installed_books_stale_cids = set()
+
+            # Save the library index with any hashes generated by the dialog
+            self._save_library_index()
 
             # Restore the Device view if active before MXD window launched
             if restore_to:
@@ -786,12 +900,39 @@ class MarvinManagerAction(InterfaceAction, Logger):
     # subclass override
     def shutting_down(self):
         self._log_location()
+        self._stop_library_prehash(save=True)
+        self._save_library_index()
 
     def start_library_indexing(self):
         self._log_location()
         self._busy_panel_setup("Indexing calibre library…")
         self.library_scanner.start()
 
+    def start_library_prehash(self):
+        '''
+        Hash new or changed library epubs in the background while calibre is idle,
+        keeping library_scanner.hash_map warm for the Marvin window
+        '''
+        if not self.prefs.get('background_library_hashing', True):
+            return
+        if self.library_prehasher is not None or self.book_status_dialog is not None:
+            return
+        if (self.gui.job_manager.has_jobs() or
+                Application.activeModalWidget() is not None):
+            # calibre is busy, try again later
+            QTimer.singleShot(self.PREHASH_RETRY_DELAY, self.start_library_prehash)
+            return
+
+        self._log_location()
+        if self._library_index_current() or self._load_library_index():
+            self._start_library_prehasher()
+        else:
+            # Index in the background, then hash
+            self.library_scanner = IndexLibrary(self)
+            self.connect(self.library_scanner, self.library_scanner.signal,
+                         self._library_prehash_indexed)
+            self.library_scanner.start(QThread.LowPriority)
+
     def _busy_panel_setup(self, title, show_cancel=False):
         '''
         '''
@@ -805,7 +946,169 @@ class MarvinManagerAction(InterfaceAction, Logger):
         '''
         '''
         self._log_location()
+        if self.busy_window is None:
+            return
         self.busy_window.stop()
         self.busy_window.accept()
         self.busy_window = None
         Application.restoreOverrideCursor()
+
+    def _library_index_current(self):
+        '''
+        Return True if library_scanner indexed the current library.
+        library_db_event keeps the index current as the library is edited, so
+        last_modified, which our own writes also move, is not compared.
+        '''
+        return (self.indexed_library is self.gui.current_db and
+                self.library_indexed and
+                self.library_scanner is not None)
+
+    def _load_library_index(self):
+        '''
+        Restore library_scanner from the snapshot saved by a prior session,
+        patched with changes made since. Return True if the snapshot was usable
+        '''
+        db = self.gui.current_db
+        path = IndexLibrary.snapshot_path(self.resources_path, db.library_id)
+        if not os.path.exists(path):
+            return False
+
+        try:
+            with open(path, 'rb') as f:
+                snapshot = json.load(f)
+            if (snapshot.get('version') != IndexLibrary.SNAPSHOT_VERSION or
+                    snapshot['library_id'] != db.library_id):
+                return False
+
+            library_scanner = IndexLibrary(self)
+            library_scanner.load_snapshot(snapshot)
+        except:
+            import traceback
+            self._log(traceback.format_exc())
+            return False
+
+        self._log_location("%d books" % len(library_scanner.uuid_map))
+        self.library_scanner = library_scanner
+        self.library_indexed = True
+        self.indexed_library = db
+        self.library_last_modified = db.last_modified()
+        self.installed_books = None
+        return True
+
+    def _library_prehash_indexed(self):
+        '''
+        Background index for start_library_prehash() complete
+        '''
+        if self.sender() is not self.library_scanner:
+            # Superseded by launch_library_scanner()
+            return
+        self.library_index_complete()
+        self._start_library_prehasher()
+
+    def _save_library_prehash(self, prehasher, hashes=None):
+        '''
+        Copy hashes {cid: (uuid, mtime, hash)} from prehasher to its uuid_map,
+        save them to the library they were computed for
+        Without hashes, the remainder after the last batch is saved and the
+        cached hashes prehasher found current are copied too
+        '''
+        if prehasher.db is not self.gui.current_db:
+            # Library changed since
+            return
+
+        uuid_map = prehasher.library_scanner.uuid_map
+        if hashes is None:
+            hashes = prehasher.hashes
+            prehasher.hashes = {}
+            for uuid, hash in prehasher.known_hashes.items():
+                if uuid in uuid_map:
+                    uuid_map[uuid]['hash'] = hash
+
+        epub_hashes = {}
+        for cid, (uuid, mtime, hash) in hashes.items():
+            if uuid in uuid_map:
+                uuid_map[uuid]['hash'] = hash
+            epub_hashes[cid] = json.dumps({'mtime': mtime, 'hash': hash})
+        save_epub_hashes(prehasher.db, epub_hashes)
+
+    def _save_library_index(self):
+        '''
+        Write a snapshot of library_scanner for the next session
+        '''
+        if not (self.library_indexed and self.library_scanner is not None):
+            return
+
+        snapshot = self.library_scanner.snapshot(self.library_last_modified)
+        path = IndexLibrary.snapshot_path(self.resources_path, snapshot['library_id'])
+        self._log_location("%d books" % len(snapshot['books']))
+        # Write beside the snapshot, then swap it in, so an interrupted write
+        # leaves the previous snapshot intact
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                json.dump(snapshot, f)
+            atomic_rename(tmp_path, path)
+        except:
+            import traceback
+            self._log(traceback.format_exc())
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _start_library_prehasher(self):
+        '''
+        Hash stale library epubs with PreHashLibrary at idle priority
+        Once hash_map is built, only books added or changed since need hashing.
+        The library is read here in two queries, PreHashLibrary finds the stale
+        epubs itself
+        '''
+        uuid_map = self.library_scanner.uuid_map
+        if self.library_scanner.hash_map is not None:
+            uuid_map = self.library_scanner.unhashed_books()
+            if not uuid_map:
+                # Already warm
+                return
+
+        db = self.gui.current_db
+        uuid_cids = [(uuid, entry['id']) for uuid, entry in uuid_map.items()]
+        epub_paths = get_epub_paths(db)
+        if epub_paths is None:
+            epub_paths = {}
+            for uuid, cid in uuid_cids:
+                try:
+                    epub_paths[cid] = db.format_abspath(cid, 'EPUB', index_is_id=True)
+                except:
+                    # Book deleted since scan
+                    pass
+        cached_hashes = db.get_all_custom_book_data('epub_hash')
+        self._log_location("%d epubs to check" % len(uuid_cids))
+
+        self.library_prehasher = PreHashLibrary(self, self.library_scanner,
+                                                uuid_cids, epub_paths, cached_hashes)
+        self.connect(self.library_prehasher, self.library_prehasher.batch_signal,
+                     self.library_prehash_batch)
+        self.connect(self.library_prehasher, self.library_prehasher.signal,
+                     self.library_prehash_complete)
+        self.library_prehasher.start(QThread.IdlePriority)
+
+    def _subscribe_to_library(self, db):
+        '''
+        calibre notifies listeners with (event, ids), possibly from a
+        non-GUI thread, so we relay through a queued signal
+        '''
+        if db is not None and db is not self.subscribed_library:
+            db.add_listener(self.library_db_changed.emit)
+            self.subscribed_library = db
+
+    def _stop_library_prehash(self, save=True):
+        '''
+        Stop a running PreHashLibrary, optionally saving what it hashed since its last batch
+        '''
+        prehasher = self.library_prehasher
+        if prehasher is None:
+            return
+        self._log_location()
+        self.library_prehasher = None
+        prehasher.stop()
+        prehasher.wait()
+        if save:
+            self._save_library_prehash(prehasher)
@@ -8,14 +8,16 @@ __copyright__ = '2013, Greg Riker <griker@hotmail.com>'
 __docformat__ = 'restructuredtext en'
 
 import base64, cStringIO, hashlib, importlib, inspect, json
-import locale, operator, os, cPickle as pickle, re, sqlite3, sys, time
+import locale, operator, os, re, sqlite3, sys, time
 
 from collections import OrderedDict
 from datetime import datetime, timedelta
 from dateutil import tz
 from functools import partial
 from lxml import etree
-from threading import Timer
+from multiprocessing import cpu_count
+from Queue import Empty, Queue
+from threading import Event, Lock, Thread, Timer
 from xml.sax.saxutils import escape
 
 from PyQt4 import QtCore
@@ -40,8 +42,9 @@ from calibre.gui2 import Application, Dispatcher, error_dialog, warning_dialog
 from calibre.gui2.dialogs.message_box import MessageBox
 from calibre.gui2.dialogs.progress import ProgressDialog
 from calibre.gui2.progress_indicator import ProgressIndicator
-from calibre.utils.config import config_dir, JSONConfig
+from calibre.utils.config import config_dir
 from calibre.utils.date import strptime
+from calibre.utils.filenames import atomic_rename
 from calibre.utils.icu import sort_key
 from calibre.utils.magick.draw import thumbnail
 from calibre.utils.wordcount import get_wordcount_obj
@@ -50,9 +53,14 @@ from calibre.utils.zipfile import ZipFile
 from calibre_plugins.marvin_manager.annotations import merge_annotations
 
 from calibre_plugins.marvin_manager.common_utils import (
-    AbortRequestException, AnnotationStruct, Book, BookStruct, InventoryCollections,
-    Logger, MyBlockingBusy, ProgressBar, RowFlasher, SizePersistedDialog,
-    get_cc_mapping, get_icon, updateCalibreGUIView)
+    AbortRequestException, AnnotationStruct, Book, BookStruct, CalibreMetadata,
+    CoverHashArchive, InstalledBooksCache, InventoryCollections, LRUCache,
+    Logger, MainDbConnection, MyBlockingBusy, ProgressBar, RemoteFile, RowFlasher,
+    SizePersistedDialog, find_stale_epubs, get_cc_mapping, get_device_id, get_icon,
+    run_batched_jobs, save_epub_hashes, updateCalibreGUIView)
+from calibre_plugins.marvin_manager.cover_hash import compute_cover_hash
+from calibre_plugins.marvin_manager.epub_hash import compute_epub_hash
+from calibre_plugins.marvin_manager.hash_cache import HashCache
 
 dialog_resources_path = os.path.join(config_dir, 'plugins', 'Marvin_XD_resources', 'dialogs')
 
@@ -850,10 +858,18 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 #     CANCEL_ACKNOWLEDGED = 2
     CHECKMARK = u"\u2713"
     CIRCLE_SLASH = u"\u20E0"
+    BOOK_ASSETS_CACHE_SIZE = 20
+    COVER_HASH_BATCH_SIZE = 50
     DEFAULT_REFRESH_TEXT = 'Refresh custom columns'
     DEFAULT_REFRESH_TOOLTIP = "<p>Refresh custom column content in calibre for the selected books.<br/>Assign custom column mappings in the <i>Customize plugin…</i> dialog.</p>"
+    EPUB_HASH_FLUSH_SIZE = 500
     HASH_CACHE_FS = "content_hashes.db"
     HIGHLIGHT_COLORS = ['Pink', 'Yellow', 'Blue', 'Green', 'Purple']
+    LIBRARY_HASH_BATCH_SIZE = 100
+    MAIN_DB_INDEXES = [('BookCollections', 'BookID'), ('Books', 'ID'),
+                       ('BookSubjects', 'BookID'), ('Highlights', 'BookID'),
+                       ('PinnedArticles', 'BookID'), ('Vocabulary', 'BookID'),
+                       ('Wiki', 'BookID')]
     MAX_BOOKS_BEFORE_SPINNER = 4
     MATH_TIMES_CIRCLED = u" \u2297 "
     MATH_TIMES = u" \u00d7 "
@@ -988,6 +1004,12 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         self._save_column_widths()
         super(BookStatusDialog, self).close()
 
+    def done(self, result):
+        self._save_installed_books_cache()
+        self.main_db.refresh_if_stale()
+        self.main_db.close()
+        super(BookStatusDialog, self).done(result)
+
     def dispatch_button_click(self, button):
         '''
         BUTTON_ROLES = ['AcceptRole', 'RejectRole', 'DestructiveRole', 'ActionRole',
@@ -1200,25 +1222,30 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         self.tv.horizontalHeader().setClickable(False)
 
     def initialize(self, parent):
+        self.book_assets = LRUCache(self.BOOK_ASSETS_CACHE_SIZE)
         self.busy = False
         self.busy_cancel_requested = False
         self.busy_panel = None
+        self.calibre_metadata = None
+        self.device_id = get_device_id(parent.ios)
         self.Dispatcher = partial(Dispatcher, parent=self)
         self.hash_cache = None
         self.icon = get_icon(parent.icon)
         self.ios = parent.ios
         self.installed_books = None
+        self.installed_books_row_state = None
+        self.main_db_checksum = None
         self.opts = parent.opts
         self.parent = parent
         self.prefs = parent.opts.prefs
         self.library_scanner = parent.library_scanner
-        self.library_title_map = None
         self.library_uuid_map = None
+        self.main_db = MainDbConnection(parent.connected_device, self._localize_marvin_database)
+        self.main_db_stats = None
         self.local_cache_folder = self.parent.connected_device.temp_dir
-        self.local_hash_cache = None
         self.marvin_cancellation_required = False
         self.remote_cache_folder = '/'.join(['/Library', 'calibre.mm'])
-        self.remote_hash_cache = None
+        self.remote_fingerprinting = RemoteFile.is_supported(self.ios)
         self.show_match_colors = self.prefs.get('show_match_colors', False)
         self.updated_match_quality = None
         self.verbose = parent.verbose
@@ -1226,7 +1253,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         # Device-specific cover_hash cache
         device_cached_hashes = "plugins/Marvin_XD_resources/{0}_cover_hashes".format(
             re.sub('\W', '_', self.ios.device_name))
-        self.archived_cover_hashes = JSONConfig(device_cached_hashes)
+        self.archived_cover_hashes = CoverHashArchive(device_cached_hashes)
 
         # Subscribe to Marvin driver change events
         self.parent.connected_device.marvin_device_signals.reader_app_status_changed.connect(
@@ -1438,7 +1465,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                 self._apply_word_count(update_gui=False)
 
             # _apply_flags may have updated Marvin mainDb
-            self._localize_marvin_database()
+            self.main_db.refresh_if_stale()
 
             updateCalibreGUIView()
             self._busy_status_teardown()
@@ -1534,7 +1561,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 
         refresh = None
 
-        if not self.installed_books[book_id].highlights:
+        if not self.installed_books[book_id].highlight_count:
             self._log("No annotations available for %s" % repr(title))
             return
 
@@ -1600,7 +1627,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         refresh = None
 
         if action == 'show_deep_view_articles':
-            if not self.installed_books[book_id].articles:
+            if not self.installed_books[book_id].article_count:
                 return
 
             command_name = "command"
@@ -1658,9 +1685,8 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             # Get a list of DV items by querying mainDb
             entities = "Entities_%d" % book_id
             entity_locations = "EntityLocations_%d" % book_id
-            con = sqlite3.connect(self.parent.connected_device.local_db_path)
+            con = self.main_db.connect()
             with con:
-                con.row_factory = sqlite3.Row
                 dv_names_cur = con.cursor()
                 if action == "show_deep_view_by_annotations":
                     dv_names_cur.execute('''SELECT
@@ -1730,7 +1756,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             footer = None
 
         elif action == 'show_vocabulary':
-            if not self.installed_books[book_id].vocabulary:
+            if not self.installed_books[book_id].vocabulary_count:
                 return
 
             command_name = "command"
@@ -1742,8 +1768,9 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 
             header = None
             group_box_title = 'Vocabulary words'
-            if self.installed_books[book_id].vocabulary:
-                word_list = '<br/>'.join(sorted(self.installed_books[book_id].vocabulary, key=sort_key))
+            vocabulary = self._get_vocabulary(book_id)
+            if vocabulary:
+                word_list = '<br/>'.join(vocabulary)
                 default_content = "<p>{0}</p>".format(word_list)
             else:
                 default_content = ("<p>No vocabulary words</p>")
@@ -1817,10 +1844,8 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         current_collections = {}
 
         # Get all Marvin collection names
-        con = sqlite3.connect(self.parent.connected_device.local_db_path)
+        con = self.main_db.connect()
         with con:
-            con.row_factory = sqlite3.Row
-
             collections_cur = con.cursor()
             collections_cur.execute('''SELECT
                                         Name
@@ -1976,7 +2001,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                            cid,
                            self.installed_books[book_id],
                            enable_metadata_updates,
-                           self.parent.connected_device.local_db_path)
+                           self.main_db)
             dlg.exec_()
             if dlg.result() == dlg.Accepted and mismatches:
                 action = dlg.stored_command
@@ -2131,7 +2156,8 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                         break
 
             # Update local_db
-            self._localize_marvin_database()
+            self.main_db.invalidate()
+            self.main_db.refresh_if_stale()
             self._busy_status_teardown()
 
             # Launch row flasher
@@ -2194,16 +2220,14 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             #UPDATE_FIELD = b'DateOpened'
             arg2 = ''
 
-            con = sqlite3.connect(self.parent.connected_device.local_db_path)
+            con = self.main_db.connect()
             with con:
-                con.row_factory = sqlite3.Row
-
                 lm_cur = con.cursor()
                 lm_cur.execute('''SELECT
                                    *
                                   FROM Books
-                                  WHERE ID = '{0}'
-                               '''.format(book_id))
+                                  WHERE ID = ?
+                               ''', (book_id,))
                 row = lm_cur.fetchone()
 
                 last_modified = datetime.now(tz.tzutc())
@@ -2698,7 +2722,8 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 
             # Update local_db for all changes
             if db_update:
-                self._localize_marvin_database()
+                self.main_db.invalidate()
+            self.main_db.refresh_if_stale()
 
             if not silent:
                 self._busy_status_teardown()
@@ -2822,7 +2847,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             self.saved_selection_region = None
 
         if update_local_db and local_update_required:
-            self._localize_marvin_database()
+            self.main_db.invalidate()
 
         Application.processEvents()
 
@@ -2837,68 +2862,30 @@ class BookStatusDialog(SizePersistedDialog, Logger):
     def _compute_epub_hash(self, zipfile):
         '''
         Generate a hash of all text and css files in epub
+        zipfile may be a path or a seekable file object (RemoteFile)
         '''
-        def _url_decode(s):
-            subs = {
-                    '%20': ' ',
-                    '%21': '!',
-                    '%22': '"',
-                    '%23': '#',
-                    '%25': '%'
-                   }
-            for k, v in subs.iteritems():
-                s = s.replace(k, v)
-            return s
-
         _local_debug = False
         #self._log_location(os.path.basename(zipfile))
+        return compute_epub_hash(zipfile, log=self._log if _local_debug else None)
 
-        # Find the OPF file in the zipped ePub, extract a list of text files
-        try:
-            zf = ZipFile(zipfile, 'r')
-            container = etree.fromstring(zf.read('META-INF/container.xml'))
-            opf_tree = etree.fromstring(zf.read(container.xpath('.//*[local-name()="rootfile"]')[0].get('full-path')))
+    def _copy_marvin_book(self, path):
+        '''
+        Copy a Marvin book to local_cache_folder for hashing
+        Return the local path, or None if the copy failed
+        '''
+        rbp = '/'.join(['/Documents', path])
+        lbp = os.path.join(self.local_cache_folder, path)
 
-            text_hrefs = []
-            manifest = opf_tree.xpath('.//*[local-name()="manifest"]')[0]
-            for item in manifest.iterchildren():
-                #self._log(etree.tostring(item, pretty_print=True))
-                mt = item.get('media-type')
-                if mt in ['application/xhtml+xml', 'text/css']:
-                    thr = item.get('href').split('/')[-1]
-                    text_hrefs.append(_url_decode(thr))
-            zf.close()
+        try:
+            with open(lbp, 'wb') as out:
+                self.ios.copy_from_idevice(str(rbp), out)
         except:
-            if _local_debug:
-                import traceback
-                self._log(traceback.format_exc())
+            # We have an invalid filename, _scan_marvin_books() assigns a unique hash
+            self._log("ERROR: Unable to open %s for output" % repr(lbp))
+            import traceback
+            self._log(traceback.format_exc())
             return None
-
-        if _local_debug:
-            self._log("{:-^80}".format(" text_hrefs[] "))
-            for th in text_hrefs:
-                self._log(th)
-            self._log("{:-^80}".format(""))
-
-        m = hashlib.md5()
-        zfi = ZipFile(zipfile).infolist()
-        for zi in zfi:
-            base = zi.filename.split('/')[-1]
-            if _local_debug:
-                #self._log("evaluating %s" % zi.filename)
-                self._log("evaluating %s" % repr(base))
-
-            if base in text_hrefs:
-                m.update(zi.filename)
-                m.update(str(zi.file_size))
-                if _local_debug:
-                    self._log(" adding filename %s" % (zi.filename))
-                    self._log(" adding file_size %s" % (zi.file_size))
-
-        if _local_debug:
-            self._log("computed hexdigest: %s" % m.hexdigest())
-
-        return m.hexdigest()
+        return lbp
 
     def _construct_table_data(self):
         '''
@@ -2907,12 +2894,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         def _generate_articles(book_data):
             '''
             '''
-            article_count = 0
-            if 'Wiki' in book_data.articles:
-                article_count += len(book_data.articles['Wiki'])
-            if 'Pinned' in book_data.articles:
-                article_count += len(book_data.articles['Pinned'])
-
+            article_count = book_data.article_count
             if article_count:
                 articles = SortableTableWidgetItem(
                     "{0}".format(article_count),
@@ -2970,10 +2952,10 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         def _generate_highlights(book_data):
             '''
             '''
-            if len(book_data.highlights):
+            if book_data.highlight_count:
                 highlights = SortableTableWidgetItem(
-                    "{0}".format(len(book_data.highlights)),
-                    len(book_data.highlights))
+                    "{0}".format(book_data.highlight_count),
+                    book_data.highlight_count)
             else:
                 highlights = SortableTableWidgetItem('', 0)
             return highlights
@@ -3106,10 +3088,10 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             return title
 
         def _generate_vocabulary(book_data):
-            if len(book_data.vocabulary):
+            if book_data.vocabulary_count:
                 vocabulary = SortableTableWidgetItem(
-                    "{0}".format(len(book_data.vocabulary)),
-                    len(book_data.vocabulary))
+                    "{0}".format(book_data.vocabulary_count),
+                    book_data.vocabulary_count)
             else:
                 vocabulary = SortableTableWidgetItem('', 0)
             return vocabulary
@@ -3198,9 +3180,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 
         # Set row height
         fm = QFontMetrics(FONT)
-        nrows = len(self.tabledata)
-        for row in xrange(nrows):
-            self.tv.setRowHeight(row, fm.height() + 4)
+        self.tv.verticalHeader().setDefaultSectionSize(fm.height() + 4)
 
         self.tvSelectionModel = self.tv.selectionModel()
         self.tv.setAlternatingRowColors(not self.show_match_colors)
@@ -3319,6 +3299,10 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 
                 # Delete the books on Device
                 if self.prefs.get('execute_marvin_commands', True):
+                    # The driver may rewrite the local mainDb while deleting
+                    self.main_db.close()
+                    self.main_db_stats = None
+
                     job = self.parent.gui.remove_paths(delete_map.keys())
 
                     # Delete books in the Device model
@@ -3451,9 +3435,8 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         self._log_location(book_ids)
 
         dvp_status = {}
-        con = sqlite3.connect(self.parent.connected_device.local_db_path)
+        con = self.main_db.connect()
         with con:
-            con.row_factory = sqlite3.Row
             # Get all the books
             cur = con.cursor()
             cur.execute('''SELECT
@@ -3470,42 +3453,46 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 
         return dvp_status
 
-    def _fetch_marvin_content_hash(self, path):
+    def _fetch_marvin_content_hash(self, path, size=None):
         '''
-        Given a Marvin path, compute/fetch a hash of its contents (excluding OPF)
-        self.hash_cache is current
+        Given a Marvin path, compute a hash of its contents (excluding OPF) in place,
+        reading only the zip directory, container.xml and OPF from the iDevice.
+        Return (True, hash), or (False, None) if the book must be copied locally
         '''
         #self._log_location(path)
+        if not self.remote_fingerprinting:
+            return False, None
 
-        # Try getting the hash from the cache
-        if path in self.hash_cache:
-            #self._log("returning hash from cache")
-            return self.hash_cache[path]
-
-        # Get a local copy of the book, generate hash
         rbp = '/'.join(['/Documents', path])
-        lbp = os.path.join(self.local_cache_folder, path)
-
+        if size is None:
+            stats = self.ios.exists(str(rbp))
+            if not stats:
+                return False, None
+            size = stats['st_size']
+
+        hash = None
+        rf = None
         try:
-            with open(lbp, 'wb') as out:
-                self.ios.copy_from_idevice(str(rbp), out)
+            rf = RemoteFile(self.ios, rbp, size)
+            hash = self._compute_epub_hash(rf)
         except:
-            # We have an invalid filename, but we need to return a unique hash
-            self._log("ERROR: Unable to open %s for output" % repr(lbp))
             import traceback
             self._log(traceback.format_exc())
-            m = hashlib.md5()
-            m.update(lbp)
-            return m.hexdigest()
+        finally:
+            if rf is not None:
+                rf.close()
 
-        hash = self._compute_epub_hash(lbp)
+        if rf is None:
+            # Couldn't open this book, copy it instead
+            return False, None
 
-        # Add it to the hash_cache
-        self.hash_cache[path] = hash
+        if rf.failed:
+            self._log("ranged reads unavailable, falling back to copying books")
+            self.remote_fingerprinting = False
+            return False, None
 
-        # Delete the local copy
-        os.remove(lbp)
-        return hash
+        #self._log("%s: %d of %d bytes read" % (path, rf.bytes_read, rf.size))
+        return True, hash
 
     def _fetch_marvin_cover(self, book_id):
         '''
@@ -3513,17 +3500,15 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         '''
         cover_bytes = None
         self._log_location("fetching large cover from cache")
-        con = sqlite3.connect(self.parent.connected_device.local_db_path)
+        con = self.main_db.connect()
         with con:
-            con.row_factory = sqlite3.Row
-
             # Fetch Hash from mainDb
             cover_cur = con.cursor()
             cover_cur.execute('''SELECT
                                   Hash
                                  FROM Books
-                                 WHERE ID = '{0}'
-                              '''.format(book_id))
+                                 WHERE ID = ?
+                              ''', (book_id,))
             row = cover_cur.fetchone()
 
         book_hash = row[b'Hash']
@@ -3568,7 +3553,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         '''
         self._log_location()
 
-        library_hash_map = library_scanner.hash_map
+        library_hash_map = library_scanner.vl_hash_map
         hard_matches = {}
         soft_matches = []
         for book in installed_books:
@@ -3626,9 +3611,8 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                 self.library_scanner.wait()
                 self._busy_panel_teardown()
 
-        # Save a reference to the title, uuid map
-        self.library_title_map = self.library_scanner.title_map
-        self.library_uuid_map = self.library_scanner.uuid_map
+        # Save a reference to the uuid map
+        self.library_uuid_map = self.library_scanner.vl_uuid_map
 
         # Get the library hash_map
         library_hash_map = self.library_scanner.hash_map
@@ -3879,13 +3863,46 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             return None
         else:
             lib_collections = []
-            db = self.opts.gui.current_db
-            mi = db.get_metadata(cid, index_is_id=True)
-            lib_collections = mi.get(cfl)
+            if self.calibre_metadata is not None and cid in self.calibre_metadata:
+                # Prefetched for this refresh
+                lib_collections = self.calibre_metadata.get_collections(cid)
+            else:
+                db = self.opts.gui.current_db
+                mi = db.get_metadata(cid, index_is_id=True)
+                lib_collections = mi.get(cfl)
             if lib_collections:
                 if type(lib_collections) is not list:
                     lib_collections = [lib_collections]
-            return sorted(lib_collections, key=sort_key)
+            return sorted(lib_collections or [], key=sort_key)
+
+    def _get_calibre_states(self, cids):
+        '''
+        Return {cid: (last_modified, cover_last_modified)} for cids still in the library
+        Books record the state of their calibre book when built, edits to calibre
+        metadata, collections or covers move it
+        '''
+        db = self.opts.gui.current_db
+        cids = set([cid for cid in cids if cid is not None])
+        states = {}
+        if not cids:
+            return states
+
+        fm = db.FIELD_MAP
+        id_col = fm['id']
+        last_modified_col = fm['last_modified']
+        for record in db.data.iterall():
+            cid = record[id_col]
+            if cid not in cids:
+                continue
+            try:
+                cover_last_modified = db.cover_last_modified(cid, index_is_id=True)
+            except:
+                # Book deleted since scan
+                continue
+            if cover_last_modified is not None:
+                cover_last_modified = cover_last_modified.isoformat()
+            states[cid] = (record[last_modified_col].isoformat(), cover_last_modified)
+        return states
 
     def _get_epub_toc(self, path, prepend_title=None):
         '''
@@ -3975,9 +3992,6 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         '''
         '''
         # ~~~~~~~~~~ Emulating get_installed_books() ~~~~~~~~~~
-        local_db_path = getattr(self.parent.connected_device, "local_db_path")
-        #self._log("local_db_path: %s" % local_db_path)
-
         template = "{0}_books"
         books_db = template.format(re.sub('\W', '_', self.ios.device_name))
         #self._log("books_db: %s" % books_db)
@@ -4016,16 +4030,14 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         self.opts.db.create_annotations_table(cached_db)
 
         # Fetch the annotations (#158)
-        con = sqlite3.connect(local_db_path)
-
+        con = self.main_db.connect()
         with con:
-            con.row_factory = sqlite3.Row
             cur = con.cursor()
             cur.execute('''
                            SELECT * FROM Highlights
-                           WHERE BookId = '{0}'
+                           WHERE BookId = ?
                            ORDER BY NoteDateTime
-                        '''.format(book_id))
+                        ''', (book_id,))
             rows = cur.fetchall()
             for row in rows:
                 # Sanitize text, note to unicode
@@ -4092,9 +4104,51 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 
         return formatted_annotations
 
+    def _get_main_db_checksum(self):
+        '''
+        Identify the mainDb installed_books is built from by the remote size and
+        mtime recorded when _localize_marvin_database() copied it. Local changes
+        to the copy, see _index_marvin_database(), don't affect it
+        Return None if we haven't copied it, or the remote mtime is unavailable
+        '''
+        stats = self.main_db_stats
+        if stats is None or stats[1] is None:
+            return None
+        return "{0}:{1}".format(*stats)
+
+    def _get_marvin_book_stats(self, cached_books):
+        '''
+        Return {path: (st_size, st_mtime)} for cached_books from one listing of /Documents
+        Books missing from the listing are stat'ed individually
+        '''
+        self._log_location()
+        listing = {}
+        try:
+            for name, stats in self.ios.listdir('/Documents', get_stats=True).items():
+                listing[name.split('/')[-1]] = stats
+        except:
+            import traceback
+            self._log(traceback.format_exc())
+
+        book_stats = {}
+        for path in cached_books:
+            stats = listing.get(path) or self.ios.exists(str('/'.join(['/Documents', path])))
+            if stats:
+                book_stats[path] = (stats.get('st_size'), stats.get('st_mtime'))
+        return book_stats
+
     def _get_marvin_collections(self, book_id):
         return sorted(self.installed_books[book_id].device_collections, key=sort_key)
 
+    def _get_installed_books_cache_key(self):
+        '''
+        Identify the library index installed_books matches were made against
+        '''
+        db = self.opts.gui.current_db
+        return {'library_id': db.library_id,
+                'library_index_checksum': self.library_scanner.checksum(),
+                'virtual_library': self.library_scanner.active_virtual_library}
+
     def _get_installed_books(self):
         '''
         Build a profile of all installed books for display
@@ -4121,98 +4175,131 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 
         Try to use previously generated installed_books if available
         '''
-        def _get_articles(cur, book_id):
+        def _build_book(row):
             '''
-            Return True if PinnedArticles or Wiki entries exist for book_id
+            Build the Book for a mainDb Books row, return (book_id, Book)
             '''
-            articles = {}
-
-            # Get PinnedArticles
-            a_cur = con.cursor()
-            a_cur.execute('''SELECT
-                              BookID,
-                              Title,
-                              URL
-                             FROM PinnedArticles
-                             WHERE BookID = '{0}'
-                          '''.format(book_id))
-            pinned_article_rows = a_cur.fetchall()
-
-            if len(pinned_article_rows):
-                pinned_articles = {}
-                for row in pinned_article_rows:
-                    pinned_articles[row[b'Title']] = row[b'URL']
-                articles['Pinned'] = pinned_articles
-
-            # Get Wiki snippets
-            a_cur.execute('''SELECT
-                              BookID,
-                              Title,
-                              Snippet
-                             FROM Wiki
-                             WHERE BookID = '{0}'
-                          '''.format(book_id))
-            wiki_rows = a_cur.fetchall()
-
-            if len(wiki_rows):
-                wiki_snippets = {}
-                for row in wiki_rows:
-                    wiki_snippets[row[b'Title']] = row[b'Snippet']
-                articles['Wiki'] = wiki_snippets
+            try:
+                cid = calibre_ids[row[b'id_']]
+                mi = self.calibre_metadata.get_metadata(cid)
 
-            return articles
+                book_id = row[b'id_']
+                # Get the primary metadata from Books
+                this_book = Book(row[b'Title'], row[b'Author'].split(', '))
+                this_book.article_count = (child_counts['PinnedArticles'].get(book_id, 0) +
+                                           child_counts['Wiki'].get(book_id, 0))
+                this_book.author_sort = row[b'AuthorSort']
+                this_book.cid = cid
+                this_book.calibre_collections = calibre_collections.get(cid)
+                this_book.calibre_state = calibre_states.get(cid)
+                this_book.comments = row[b'Description']
+                this_book.cover_file = row[b'CoverFile']
+                this_book.date_added = row[b'DateAdded']
+                this_book.date_opened = row[b'DateOpened']
+                this_book.device_collections = _get_collections(book_id)
+                this_book.deep_view_prepared = row[b'DeepViewPrepared']
+                this_book.flags = _get_flags(cur, row)
+                this_book.hash = hashes[row[b'FileName']]['hash']
+                this_book.highlight_count = child_counts['Highlights'].get(book_id, 0)
+                this_book.metadata_mismatches = _get_metadata_mismatches(book_id, row, mi, this_book)
+                this_book.mid = book_id
+                this_book.on_device = _get_on_device_status(this_book.cid)
+                this_book.path = row[b'FileName']
+                this_book.pin = row[b'Pin']
+                this_book.progress = row[b'Progress']
+                this_book.pubdate = _get_pubdate(row)
+                this_book.series = row[b'CalibreSeries']
+                this_book.series_index = row[b'CalibreSeriesIndex']
+                this_book.tags = _get_marvin_genres(book_id)
+                this_book.title_sort = row[b'CalibreTitleSort']
+                this_book.uuid = row[b'UUID']
+                this_book.vocabulary_count = child_counts['Vocabulary'].get(book_id, 0)
+                this_book.word_count = locale.format("%d", row[b'WordCount'], grouping=True)
+                return book_id, this_book
+            except:
+                self._log("ERROR adding to installed_books")
+                import traceback
+                self._log(traceback.format_exc())
 
-        def _get_calibre_id(uuid, title, author):
+        def _get_child_counts(con):
             '''
-            Find book in library, return cid, mi
+            Count the rows of each asset table of Books, by BookID
+            Only counts are displayed, the assets themselves are loaded when viewed
+            Articles are counted by title
+            {table: {book_id: count}, ...}
+            '''
+            counted_tables = {
+                'Highlights': 'COUNT(*)',
+                'PinnedArticles': 'COUNT(DISTINCT Title)',
+                'Vocabulary': 'COUNT(*)',
+                'Wiki': 'COUNT(DISTINCT Title)'
+                }
+            child_counts = {}
+            for table, aggregate in counted_tables.items():
+                count_cur = con.cursor()
+                count_cur.execute('''SELECT BookID, {0}
+                                     FROM {1}
+                                     GROUP BY BookID
+                                  '''.format(aggregate, table))
+                child_counts[table] = dict(count_cur.fetchall())
+                count_cur.close()
+            return child_counts
+
+        def _get_child_rows(con):
+            '''
+            Read each child table of Books once, grouping the rows by BookID
+            {table: {book_id: [row, ...]}, ...}
+            '''
+            child_tables = {
+                'BookCollections': 'BookID, CollectionID',
+                'BookSubjects': 'BookID, Subject'
+                }
+            child_rows = {}
+            for table, columns in child_tables.items():
+                grouped = {}
+                child_cur = con.cursor()
+                child_cur.execute('''SELECT {0}
+                                     FROM {1}
+                                  '''.format(columns, table))
+                for row in child_cur:
+                    grouped.setdefault(row[b'BookID'], []).append(row)
+                child_cur.close()
+                child_rows[table] = grouped
+            return child_rows
+
+        def _get_calibre_id(uuid, title, author, hash):
+            '''
+            Find book in library index, return cid
+            Title/author duplicates are narrowed to those matching the Marvin content hash
+            Metadata is prefetched for all matches, see CalibreMetadata
             '''
             if self.opts.prefs.get('development_mode', False):
                 self._log_location("%s %s" % (repr(title), repr(author)))
             cid = None
-            mi = None
-            db = self.opts.gui.current_db
-            try:
-                if uuid in self.library_uuid_map:
-                    cid = self.library_uuid_map[uuid]['id']
-                    mi = db.get_metadata(cid, index_is_id=True, get_cover=True, cover_as_data=True)
+            if uuid in self.library_uuid_map:
+                cid = self.library_uuid_map[uuid]['id']
+                if self.opts.prefs.get('development_mode', False):
+                    self._log("UUID match")
+            else:
+                cids = self.library_scanner.find_by_title_author(title, author, hash=hash)
+                if cids:
+                    cid = cids[0]
+                    if len(cids) > 1:
+                        self._log("%s: %d ambiguous TITLE/AUTHOR matches %s, using %d" %
+                                  (repr(title), len(cids), cids, cid))
                     if self.opts.prefs.get('development_mode', False):
-                        self._log("UUID match")
-                elif title in self.library_title_map:
-                    _cid = self.library_title_map[title]['id']
-                    _mi = db.get_metadata(_cid, index_is_id=True, get_cover=True, cover_as_data=True)
-                    authors = author.split(', ')
-                    if authors == _mi.authors:
-                        cid = _cid
-                        mi = _mi
-                        if self.opts.prefs.get('development_mode', False):
-                            self._log("TITLE/AUTHOR match")
-            except:
-                # Book deleted since scan
-                import traceback
-                self._log_location(traceback.format_exc())
-
-            # Confirm valid mi object
-            if getattr(mi, 'uuid', None) == 'dummy':
-                mi = None
-            return cid, mi
+                        self._log("TITLE/AUTHOR match")
+            return cid
 
-        def _get_collections(cur, book_id):
+        def _get_collections(book_id):
             # Get the collection assignments
-            ca_cur = con.cursor()
-            ca_cur.execute('''SELECT
-                                BookID,
-                                CollectionID
-                              FROM BookCollections
-                              WHERE BookID = '{0}'
-                           '''.format(book_id))
             collections = []
-            collection_rows = ca_cur.fetchall()
-            if collection_rows is not None:
+            collection_rows = child_rows['BookCollections'].get(book_id, [])
+            if collection_rows:
                 collection_assignments = [collection[b'CollectionID']
                                           for collection in collection_rows]
                 collections += [collection_map[item] for item in collection_assignments]
                 collections = sorted(collections, key=sort_key)
-            ca_cur.close()
             return collections
 
         def _get_flags(cur, row):
@@ -4226,87 +4313,19 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                 flags.append(self.FLAGS['read'])
             return flags
 
-        def _get_highlights(cur, book_id):
-            '''
-            Return highlight text/notes associated with book_id
-            '''
-            hl_cur = con.cursor()
-            hl_cur.execute('''SELECT
-                                Note,
-                                Text
-                              FROM Highlights
-                              WHERE BookID = '{0}'
-                           '''.format(book_id))
-            hl_rows = hl_cur.fetchall()
-            highlight_list = []
-            if len(hl_rows):
-                for row in hl_rows:
-                    raw_text = row[b'Text']
-                    text = "<p>{0}".format(raw_text)
-                    if row[b'Note']:
-                        raw_note = row[b'Note']
-                        text += "<br/>&nbsp;<em>{0}</em></p>".format(raw_note)
-                    else:
-                        text += "</p>"
-                    highlight_list.append(text)
-            hl_cur.close()
-            return highlight_list
-
         def _get_marvin_genres(book_id):
             # Return sorted genre(s) for this book
-            genre_cur = con.cursor()
-            genre_cur.execute('''SELECT
-                                    Subject
-                                 FROM BookSubjects
-                                 WHERE BookID = '{0}'
-                              '''.format(book_id))
-            genres = []
-            genre_rows = genre_cur.fetchall()
-            if genre_rows is not None:
-                genres = [genre[b'Subject'] for genre in genre_rows]
-            genre_cur.close()
+            genre_rows = child_rows['BookSubjects'].get(book_id, [])
+            genres = [genre[b'Subject'] for genre in genre_rows]
             genres = sorted(genres, key=sort_key)
             return genres
 
-        def _get_metadata_mismatches(cur, book_id, row, mi, this_book):
+        def _get_metadata_mismatches(book_id, row, mi, this_book):
             '''
             Return dict of metadata mismatches.
             author, author_sort, pubdate, publisher, series, series_index, title,
             title_sort, description, subjects, collections, cover
             '''
-            def _get_cover_hash(mi, this_book):
-                '''
-                Retrieve cover_hash from archive, or create/store
-                '''
-                #self._log_location(this_book.title)
-                ach = self.archived_cover_hashes.get(str(this_book.cid), {})
-                cover_last_modified = self.opts.gui.current_db.cover_last_modified(this_book.cid, index_is_id=True)
-                if ('cover_last_modified' in ach and
-                        ach['cover_last_modified'] == cover_last_modified):
-                    #self._log("returning cached cover_hash %s" % ach['cover_hash'])
-                    return ach['cover_hash']
-
-                # Generate calibre cover hash (same process used by driver when sending books)
-                cover_hash = '0'
-                desired_thumbnail_height = self.parent.connected_device.THUMBNAIL_HEIGHT
-                try:
-                    #self._log("mi.cover_data[0]: %s" % repr(mi.cover_data[0]))
-                    sized_thumb = thumbnail(mi.cover_data[1],
-                                            desired_thumbnail_height,
-                                            desired_thumbnail_height)
-                    cover_hash = hashlib.md5(sized_thumb[2]).hexdigest()
-                    cover_last_modified = self.opts.gui.current_db.cover_last_modified(this_book.cid, index_is_id=True)
-                    self.archived_cover_hashes.set(str(this_book.cid),
-                                                   {'cover_hash': cover_hash,
-                                                    'cover_last_modified': cover_last_modified})
-                except:
-                    if mi.cover_data[1]:
-                        self._log_location("error calculating cover_hash for %s (cid %d)" %
-                        (this_book.title, this_book.cid))
-                    else:
-                        self._log_location("no cover available for %s" % this_book.title)
-                return cover_hash
-
             #self._log_location(row[b'Title'])
             mismatches = {}
             if mi is not None:
@@ -4321,7 +4340,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                                                  'Marvin': row[b'AuthorSort']}
 
                 # ~~~~~~~~ cover_hash ~~~~~~~~
-                cover_hash = _get_cover_hash(mi, this_book)
+                cover_hash = self.calibre_metadata.get_cover_hash(this_book.cid)
                 if cover_hash != row[b'CalibreCoverHash']:
                     mismatches['cover_hash'] = {'calibre': cover_hash,
                                                 'Marvin': row[b'CalibreCoverHash']}
@@ -4399,9 +4418,11 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                                                   'Marvin': row[b'Description']}
 
                 # ~~~~~~~~ tags ~~~~~~~~
-                if sorted(mi.tags, key=sort_key) != _get_marvin_genres(book_id):
-                    mismatches['tags'] = {'calibre': sorted(mi.tags, key=sort_key),
-                                          'Marvin': _get_marvin_genres(book_id)}
+                calibre_tags = sorted(mi.tags, key=sort_key)
+                marvin_genres = _get_marvin_genres(book_id)
+                if calibre_tags != marvin_genres:
+                    mismatches['tags'] = {'calibre': calibre_tags,
+                                          'Marvin': marvin_genres}
 
                 # ~~~~~~~~ uuid ~~~~~~~~
                 if mi.uuid != row[b'UUID']:
@@ -4423,14 +4444,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 
             ans = None
             if cid:
-                db = self.opts.gui.current_db
-                mi = db.get_metadata(cid, index_is_id=True)
-                try:
-                    ans = mi._proxy_metadata.ondevice_col
-                except:
-                    self._log_location("ERROR: ondevice_col not available for '%s'" % mi.title)
-                    #self._log(mi.all_field_keys())
-                    ans = None
+                ans = self.calibre_metadata.get_on_device(cid)
             return ans
 
         def _get_pubdate(row):
@@ -4456,44 +4470,19 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                 publisher = None
             return publisher
 
-        def _get_vocabulary_list(cur, book_id):
-            # Get the vocabulary content
-            voc_cur = con.cursor()
-            voc_cur.execute('''SELECT
-                                BookID,
-                                Word
-                              FROM Vocabulary
-                              WHERE BookID = '{0}'
-                           '''.format(book_id))
-
-            vocabulary_rows = voc_cur.fetchall()
-            vocabulary_list = []
-            if len(vocabulary_rows):
-                vocabulary_list = [vocabulary_item[b'Word']
-                                   for vocabulary_item in vocabulary_rows]
-                vocabulary_list = sorted(vocabulary_list, key=sort_key)
-            voc_cur.close()
-            return vocabulary_list
-
-        def _purge_cover_hash_orphans():
+        def _get_row_state(row):
             '''
-            Purge obsolete cover hashes
+            Checksum of the mainDb content a Book is built from
             '''
-            self._log_location()
-            # Get active cids
-            active_cids = sorted([str(installed_books[book_id].cid) for book_id in installed_books])
-            #self._log("active_cids: %s" % active_cids)
-
-            # Get active cover_hash cids
-            cover_hash_cids = sorted(self.archived_cover_hashes.keys())
-            #self._log("cover_hash keys: %s" % cover_hash_cids)
-
-            self._busy_panel_setup("Removing obsolete cover hashes")
-            for ch_cid in cover_hash_cids:
-                if ch_cid not in active_cids:
-                    self._log("removing orphan cid %s from archived_cover_hashes" % ch_cid)
-                    del self.archived_cover_hashes[ch_cid]
-            self._busy_panel_teardown()
+            book_id = row[b'id_']
+            state = [tuple(row), hashes[row[b'FileName']]['hash']]
+            for table in sorted(child_rows):
+                state.append([tuple(child_row) for child_row in child_rows[table].get(book_id, [])])
+            for table in sorted(child_counts):
+                state.append(child_counts[table].get(book_id, 0))
+            # Collections are shown by name
+            state.append(_get_collections(book_id))
+            return hashlib.md5(repr(state)).hexdigest()
 
         # ~~~~~~~~~~~~~ Entry point ~~~~~~~~~~~~~~~~~~
 
@@ -4501,7 +4490,14 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 
         marvin_content_updated = getattr(self.parent, 'marvin_content_updated', False)
         installed_books = getattr(self.parent, 'installed_books', None)
-        if installed_books is None or marvin_content_updated:
+        self.installed_books_row_state = getattr(self.parent, 'installed_books_row_state', None)
+        self.main_db_checksum = getattr(self.parent, 'installed_books_main_db_checksum', None)
+        stale_cids = getattr(self.parent, 'installed_books_stale_cids', set())
+        if installed_books is None or marvin_content_updated or stale_cids:
+            # Books whose mainDb content is unchanged since installed_books was built
+            # are reused, see _get_row_state()
+            previous_books = installed_books or {}
+            previous_row_state = self.installed_books_row_state or {}
             if marvin_content_updated:
                 setattr(self.parent, 'marvin_content_updated', False)
 
@@ -4522,123 +4518,165 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             # Is there a valid mainDb?
             local_db_path = getattr(self.parent.connected_device, "local_db_path")
             if local_db_path is not None:
-                # Fetch/compute hashes
-                cached_books = self.parent.connected_device.cached_books
-                hashes = self._scan_marvin_books(cached_books)
-
-                # Get the mainDb data
-                con = sqlite3.connect(self.parent.connected_device.local_db_path)
-                with con:
-                    con.row_factory = sqlite3.Row
-
-                    # Build a collection map
-                    collections_cur = con.cursor()
-                    collections_cur.execute('''SELECT
-                                                ID,
-                                                Name
-                                               FROM Collections
-                                            ''')
-                    rows = collections_cur.fetchall()
-                    collection_map = {}
-                    for row in rows:
-                        collection_map[row[b'ID']] = row[b'Name']
-                    collections_cur.close()
-
-                    # Get the books
-                    cur = con.cursor()
-                    cur.execute('''SELECT
-                                    Author,
-                                    AuthorSort,
-                                    Books.ID as id_,
-                                    CalibreCoverHash,
-                                    CalibreSeries,
-                                    CalibreSeriesIndex,
-                                    CalibreTitleSort,
-                                    CoverFile,
-                                    DateAdded,
-                                    DateOpened,
-                                    DatePublished,
-                                    DeepViewPrepared,
-                                    Description,
-                                    FileName,
-                                    IsRead,
-                                    NewFlag,
-                                    Pin,
-                                    Progress,
-                                    Publisher,
-                                    ReadingList,
-                                    Title,
-                                    UUID,
-                                    WordCount
-                                  FROM Books
-                                ''')
-
-                    rows = cur.fetchall()
+                # Read our own copy, so main_db_stats describes the rows we read.
+                # The driver's copy may predate changes Marvin has made since
+                try:
+                    self._localize_marvin_database()
+                except:
+                    # Fall back to the driver's copy, without an identity to cache it under
+                    import traceback
+                    self._log(traceback.format_exc())
+                    self._index_marvin_database()
+                self.main_db_checksum = self._get_main_db_checksum()
+
+                # Books saved by a prior session, matched against this library
+                disk_cache = None
+                if not previous_books:
+                    disk_cache = self._load_installed_books_cache()
+                    if disk_cache is not None:
+                        previous_books = disk_cache['books']
+                        previous_row_state = disk_cache['row_state']
+
+                # Rebuild books matched to calibre books edited since they were built,
+                # as reported by library events or by the calibre books' timestamps
+                calibre_states = self._get_calibre_states(
+                    [book.cid for book in previous_books.values()])
+                stale_books = set([book_id for book_id, book in previous_books.items()
+                                   if book.cid in stale_cids or
+                                   getattr(book, 'calibre_state', None) != calibre_states.get(book.cid)])
+                if stale_books:
+                    self._log("%d books matched to edited calibre books, rebuilding them" %
+                              len(stale_books))
+                    previous_row_state = dict([(book_id, row_state)
+                        for book_id, row_state in previous_row_state.items()
+                        if book_id in previous_books and book_id not in stale_books])
+
+                if (disk_cache is not None and not stale_books and
+                        disk_cache['main_db_checksum'] == self.main_db_checksum):
+                    # mainDb unchanged, no need to scan
+                    self._log("restored %d books from installed_books cache" % len(previous_books))
+                    installed_books = previous_books
+                    self.installed_books_row_state = previous_row_state
+                else:
+                    # Fetch/compute hashes
+                    cached_books = self.parent.connected_device.cached_books
+                    hashes = self._scan_marvin_books(cached_books)
+
+                    # Get the mainDb data
+                    con = self.main_db.connect()
+                    with con:
+                        # Build a collection map
+                        collections_cur = con.cursor()
+                        collections_cur.execute('''SELECT
+                                                    ID,
+                                                    Name
+                                                   FROM Collections
+                                                ''')
+                        rows = collections_cur.fetchall()
+                        collection_map = {}
+                        for row in rows:
+                            collection_map[row[b'ID']] = row[b'Name']
+                        collections_cur.close()
+
+                        # Read the child tables once, grouped by BookID
+                        child_counts = _get_child_counts(con)
+                        child_rows = _get_child_rows(con)
+
+                        # Get the books
+                        cur = con.cursor()
+                        cur.execute('''SELECT
+                                        Author,
+                                        AuthorSort,
+                                        Books.ID as id_,
+                                        CalibreCoverHash,
+                                        CalibreSeries,
+                                        CalibreSeriesIndex,
+                                        CalibreTitleSort,
+                                        CoverFile,
+                                        DateAdded,
+                                        DateOpened,
+                                        DatePublished,
+                                        DeepViewPrepared,
+                                        Description,
+                                        FileName,
+                                        IsRead,
+                                        NewFlag,
+                                        Pin,
+                                        Progress,
+                                        Publisher,
+                                        ReadingList,
+                                        Title,
+                                        UUID,
+                                        WordCount
+                                      FROM Books
+                                    ''')
 
-                    pb = ProgressBar(parent=self.opts.gui, window_title="Scanning Marvin library: 2 of 2")
-                    book_count = len(rows)
-                    pb.set_maximum(book_count)
-                    pb.set_value(0)
-                    pb.set_label('{:^100}'.format("Performing metadata magic…"))
-                    pb.show()
+                        rows = cur.fetchall()
 
-                    for i, row in enumerate(rows):
-                        try:
-                            cid, mi = _get_calibre_id(row[b'UUID'],
-                                                      row[b'Title'],
-                                                      row[b'Author'])
+                        # Match Marvin books to the library
+                        calibre_ids = {}
+                        for row in rows:
+                            calibre_ids[row[b'id_']] = _get_calibre_id(row[b'UUID'],
+                                                                       row[b'Title'],
+                                                                       row[b'Author'],
+                                                                       hashes[row[b'FileName']]['hash'])
 
+                        # Reuse unchanged books, build the rest
+                        self.installed_books_row_state = {}
+                        rows_to_build = []
+                        for row in rows:
                             book_id = row[b'id_']
-                            # Get the primary metadata from Books
-                            this_book = Book(row[b'Title'], row[b'Author'].split(', '))
-                            this_book.articles = _get_articles(cur, book_id)
-                            this_book.author_sort = row[b'AuthorSort']
-                            this_book.cid = cid
-                            this_book.calibre_collections = self._get_calibre_collections(this_book.cid)
-                            this_book.comments = row[b'Description']
-                            this_book.cover_file = row[b'CoverFile']
-                            this_book.date_added = row[b'DateAdded']
-                            this_book.date_opened = row[b'DateOpened']
-                            this_book.device_collections = _get_collections(cur, book_id)
-                            this_book.deep_view_prepared = row[b'DeepViewPrepared']
-                            this_book.flags = _get_flags(cur, row)
-                            this_book.hash = hashes[row[b'FileName']]['hash']
-                            this_book.highlights = _get_highlights(cur, book_id)
-                            this_book.metadata_mismatches = _get_metadata_mismatches(cur, book_id, row, mi, this_book)
-                            this_book.mid = book_id
-                            this_book.on_device = _get_on_device_status(this_book.cid)
-                            this_book.path = row[b'FileName']
-                            this_book.pin = row[b'Pin']
-                            this_book.progress = row[b'Progress']
-                            this_book.pubdate = _get_pubdate(row)
-                            this_book.series = row[b'CalibreSeries']
-                            this_book.series_index = row[b'CalibreSeriesIndex']
-                            this_book.tags = _get_marvin_genres(book_id)
-                            this_book.title_sort = row[b'CalibreTitleSort']
-                            this_book.uuid = row[b'UUID']
-                            this_book.vocabulary = _get_vocabulary_list(cur, book_id)
-                            this_book.word_count = locale.format("%d", row[b'WordCount'], grouping=True)
-                            installed_books[book_id] = this_book
-                        except:
-                            self._log("ERROR adding to installed_books")
-                            import traceback
-                            self._log(traceback.format_exc())
-
-                        pb.increment()
-
-                    pb.hide()
-
-                # Remove orphan cover_hashes, but only if we're dealing with entire library
-                mdb = self.opts.gui.library_view.model().db
-                current_vl = mdb.data.get_base_restriction_name()
-                if current_vl == '':
-                    _purge_cover_hash_orphans()
-
-                if self.opts.prefs.get('development_mode', False):
-                    self._log("%d cached books from Marvin:" % len(cached_books))
-                    for book in installed_books:
-                        self._log("%s pubdate: %s" % (installed_books[book].title,
-                                                         repr(installed_books[book].pubdate)))
+                            row_state = _get_row_state(row)
+                            self.installed_books_row_state[book_id] = row_state
+                            if (book_id in previous_books and
+                                    previous_row_state.get(book_id) == row_state and
+                                    previous_books[book_id].cid == calibre_ids[book_id]):
+                                installed_books[book_id] = previous_books[book_id]
+                            else:
+                                rows_to_build.append(row)
+                        self._log("reusing %d books, building %d" %
+                                  (len(installed_books), len(rows_to_build)))
+
+                        # Fetch calibre metadata for the books to build in one pass
+                        build_cids = [calibre_ids[row[b'id_']] for row in rows_to_build]
+                        calibre_states.update(self._get_calibre_states(build_cids))
+                        self.calibre_metadata = CalibreMetadata(self.opts.gui.current_db,
+                            get_cc_mapping('collections', 'field', None))
+                        self.calibre_metadata.prefetch(build_cids)
+
+                        # Resolve collections and cover hashes once per cid
+                        calibre_collections = dict([(cid, self._get_calibre_collections(cid))
+                                                    for cid in set(build_cids)])
+                        self._hash_stale_covers(build_cids)
+
+                        if rows_to_build:
+                            pb = ProgressBar(parent=self.opts.gui,
+                                             window_title="Scanning Marvin library: 2 of 2")
+                            pb.set_maximum(len(rows_to_build))
+                            pb.set_value(0)
+                            pb.set_label('{:^100}'.format("Performing metadata magic…"))
+                            pb.show()
+                            for row in rows_to_build:
+                                built = _build_book(row)
+                                if built is not None:
+                                    book_id, this_book = built
+                                    installed_books[book_id] = this_book
+                                pb.increment()
+                            pb.hide()
+                        self.calibre_metadata = None
+
+                    # Remove orphan cover_hashes, but only if we're dealing with entire library
+                    mdb = self.opts.gui.library_view.model().db
+                    current_vl = mdb.data.get_base_restriction_name()
+                    if current_vl == '':
+                        active_cids = set([str(book.cid) for book in installed_books.values()])
+                        orphans = self.archived_cover_hashes.purge(active_cids)
+                        if orphans:
+                            self._log("removed %d orphan cids from archived_cover_hashes" %
+                                      len(orphans))
+
+                    # Write cover hash changes from this refresh
+                    self.archived_cover_hashes.flush()
             else:
                 self._log("Marvin database is damaged")
                 title = "Damaged database"
@@ -4648,6 +4686,156 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 
         return installed_books
 
+    def _get_vocabulary(self, book_id):
+        '''
+        Return the sorted vocabulary words for book_id from mainDb
+        Recently viewed lists are held in book_assets
+        '''
+        key = ('vocabulary', book_id)
+        if key not in self.book_assets:
+            con = self.main_db.connect()
+            with con:
+                cur = con.cursor()
+                cur.execute('''SELECT Word
+                               FROM Vocabulary
+                               WHERE BookID = ?
+                            ''', (book_id,))
+                vocabulary = sorted([row[0] for row in cur.fetchall()], key=sort_key)
+            self.book_assets.set(key, vocabulary)
+        return self.book_assets.get(key)
+
+    def _hash_stale_covers(self, cids):
+        '''
+        Resolve the calibre cover hash of each cid into calibre_metadata
+        Archived hashes are reused while cover_last_modified is unchanged.
+        Large sets of stale covers are fanned out in batches to a pool of worker
+        processes, thumbnailing at THUMBNAIL_HEIGHT. Anything left over, including
+        books without covers, is hashed serially.
+        '''
+        def _store_cover_hashes(batch, hashes):
+            '''
+            Archive a batch of {cid: cover_hash} from run_batched_jobs()
+            A failed batch is left to the serial pass
+            '''
+            pb.set_value(pb.progressBar.value() + len(batch))
+            for cid, cover_hash in (hashes or {}).items():
+                if cover_hash is not None:
+                    self.archived_cover_hashes.set(str(cid),
+                                                   {'cover_hash': cover_hash,
+                                                    'cover_last_modified': cover_info.pop(cid)})
+                    self.calibre_metadata.set_cover_hash(cid, cover_hash)
+
+        db = self.opts.gui.current_db
+        height = self.parent.connected_device.THUMBNAIL_HEIGHT
+        stale_covers = []
+        cover_info = {}
+        for cid in set(cids):
+            if cid is None:
+                continue
+            try:
+                cover_last_modified = db.cover_last_modified(cid, index_is_id=True)
+                ach = self.archived_cover_hashes.get(str(cid), {})
+                if ('cover_last_modified' in ach and
+                        ach['cover_last_modified'] == cover_last_modified):
+                    self.calibre_metadata.set_cover_hash(cid, ach['cover_hash'])
+                    continue
+                cover_info[cid] = cover_last_modified
+                if cover_last_modified is not None:
+                    path = os.path.join(db.abspath(cid, index_is_id=True, create_dirs=False),
+                                        'cover.jpg')
+                    stale_covers.append((cid, path))
+            except:
+                # Book deleted since scan
+                pass
+
+        batch_size = self.COVER_HASH_BATCH_SIZE
+        if len(stale_covers) > batch_size:
+            pool_size = max(1, self.prefs.get('cover_hash_workers', cpu_count()))
+            self._log_location("hashing %d covers in batches of %d, %d workers" %
+                               (len(stale_covers), batch_size, pool_size))
+            pb = ProgressBar(parent=self.opts.gui, window_title="Scanning Marvin library: 2 of 2")
+            pb.set_maximum(len(stale_covers))
+            pb.set_value(0)
+            pb.set_label('{:^100}'.format("Hashing %d calibre covers…" % len(stale_covers)))
+            pb.show()
+            try:
+                run_batched_jobs('calibre_plugins.marvin_manager.cover_hash', 'hash_covers',
+                                 [stale_covers[i:i + batch_size]
+                                  for i in range(0, len(stale_covers), batch_size)],
+                                 _store_cover_hashes, pool_size=pool_size, args=(height,),
+                                 description="Hashing calibre covers")
+            finally:
+                pb.hide()
+
+        # Generate calibre cover hash (same process used by driver when sending books)
+        for cid, cover_last_modified in cover_info.items():
+            cover_hash = '0'
+            cover_data = None
+            try:
+                cover_data = self.calibre_metadata.get_cover(cid)
+                cover_hash = compute_cover_hash(cover_data, height)
+                self.archived_cover_hashes.set(str(cid),
+                                               {'cover_hash': cover_hash,
+                                                'cover_last_modified': cover_last_modified})
+            except:
+                if cover_data:
+                    self._log_location("error calculating cover_hash for cid %d" % cid)
+                else:
+                    self._log_location("no cover available for cid %d" % cid)
+            self.calibre_metadata.set_cover_hash(cid, cover_hash)
+
+    def _index_marvin_database(self):
+        '''
+        Add the indexes our lookups need to the local copy of mainDb, then ANALYZE
+        Marvin's indexes serve its own access patterns. Tables missing from older
+        versions of Marvin are skipped, as are columns already leading an index.
+        local_db_path is the driver's scratch copy, which we already overwrite in
+        _localize_marvin_database(). It is never written back to the iDevice, and
+        indexes leave its rows untouched. Its identity for installed_books is the
+        remote mainDb's size and mtime, see _get_main_db_checksum()
+        '''
+        started = time.time()
+        created = []
+
+        # Writes need their own connection, the shared one is read-only
+        self.main_db.close()
+        con = sqlite3.connect(self.parent.connected_device.local_db_path)
+        try:
+            with con:
+                tables = set([row[0] for row in con.execute('''SELECT name
+                                                                 FROM sqlite_master
+                                                                 WHERE type = 'table'
+                                                              ''')])
+                for table, column in self.MAIN_DB_INDEXES:
+                    if table not in tables:
+                        continue
+
+                    # INTEGER PRIMARY KEY is the rowid, already indexed
+                    indexed = set([row[1] for row in con.execute('''PRAGMA table_info({0})
+                                                                 '''.format(table))
+                                   if row[5] and row[2].upper() == 'INTEGER'])
+                    for index in con.execute('''PRAGMA index_list({0})'''.format(table)).fetchall():
+                        index_columns = con.execute('''PRAGMA index_info("{0}")
+                                                     '''.format(index[1])).fetchall()
+                        indexed.update([row[2] for row in index_columns if row[0] == 0])
+                    if column in indexed:
+                        continue
+
+                    con.execute('''CREATE INDEX mxd_{0}_{1} ON {0} ({1})'''.format(table, column))
+                    created.append('{0}.{1}'.format(table, column))
+
+                # Statistics for the query planner, stale once indexes are added
+                if created:
+                    con.execute('''ANALYZE''')
+        except:
+            import traceback
+            self._log(traceback.format_exc())
+        finally:
+            con.close()
+
+        self._log_location("indexed %s in %.2fs" % (', '.join(created) or 'nothing',
+                                                    time.time() - started))
+
     def _inject_css(self, html):
         '''
         stick a <style> element into html
@@ -4807,8 +4995,23 @@ class BookStatusDialog(SizePersistedDialog, Logger):
     def _localize_marvin_database(self):
         '''
         Copy remote_db_path from iOS to local storage using device pointers
+        Skipped if the remote size and mtime are unchanged since our last copy
         '''
         self._log_location("starting")
+
+        local_db_path = self.parent.connected_device.local_db_path
+        remote_db_path = self.parent.connected_device.books_subpath
+
+        # Report size of remote_db
+        stats = self.ios.exists(remote_db_path)
+        self._log("mainDb: {:,} bytes".format(int(stats['st_size'])))
+
+        remote_stats = (stats.get('st_size'), stats.get('st_mtime'))
+        if (remote_stats[1] is not None and remote_stats == self.main_db_stats and
+                os.path.exists(local_db_path)):
+            self._log_location("mainDb unchanged, finished")
+            return
+
         msg = "Refreshing database"
         local_busy = False
         if self.busy:
@@ -4817,101 +5020,87 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             local_busy = True
             self._busy_status_setup(msg=msg)
 
-        local_db_path = self.parent.connected_device.local_db_path
-        remote_db_path = self.parent.connected_device.books_subpath
+        # Release the shared connection before replacing the file beneath it
+        self.main_db.close()
 
-        # Report size of remote_db
-        stats = self.ios.exists(remote_db_path)
-        self._log("mainDb: {:,} bytes".format(int(stats['st_size'])))
+        # Copy beside the local copy, then swap it in, so an interrupted transfer
+        # leaves the previous copy intact
+        tmp_db_path = local_db_path + '.tmp'
+        try:
+            with open(tmp_db_path, 'wb') as out:
+                self.ios.copy_from_idevice(remote_db_path, out)
+            atomic_rename(tmp_db_path, local_db_path)
+        except:
+            self.main_db_stats = None
+            if os.path.exists(tmp_db_path):
+                os.remove(tmp_db_path)
+            raise
+        self.main_db_stats = remote_stats
+        self._index_marvin_database()
 
-        with open(local_db_path, 'wb') as out:
-            self.ios.copy_from_idevice(remote_db_path, out)
+        # Assets loaded from the previous copy may be stale
+        self.book_assets.clear()
 
         if local_busy:
             self._busy_status_teardown()
         self._log_location("finished")
 
-    def _localize_hash_cache(self, cached_books):
+    def _load_installed_books_cache(self):
         '''
-        Check for existence of hash cache on iDevice. Confirm/create folder
-        If existing cached, purge orphans
+        Return installed_books saved by a prior session for this device, if built
+        against the current library index
         '''
         self._log_location()
+        disk_cache = None
+        try:
+            disk_cache = InstalledBooksCache(self.parent.resources_path,
+                                             self.device_id).load()
+            if (disk_cache is not None and
+                    disk_cache['key'] != self._get_installed_books_cache_key()):
+                self._log("library has changed since installed_books cache was saved")
+                disk_cache = None
+        except:
+            import traceback
+            self._log(traceback.format_exc())
+            disk_cache = None
+        return disk_cache
 
-        # Existing hash cache?
-        lhc = os.path.join(self.local_cache_folder, self.HASH_CACHE_FS)
-        rhc = '/'.join([self.remote_cache_folder, self.HASH_CACHE_FS])
-
-        cache_exists = (self.ios.exists(rhc) and
-                        not self.opts.prefs.get('hash_caching_disabled'))
-        if cache_exists:
-            # Copy from existing remote cache to local cache
-            with open(lhc, 'wb') as out:
-                self.ios.copy_from_idevice(str(rhc), out)
-
-            # Load hash_cache to memory
-            with open(lhc, 'rb') as hcf:
-                hash_cache = pickle.load(hcf)
-
-            self._log("remote hash cache: v{0}, {1} books in cache".format(
-                hash_cache['version'],
-                len(hash_cache) - 1))
-
-        else:
-            # Confirm path to remote folder is valid store point
-            folder_exists = self.ios.exists(self.remote_cache_folder)
-            if not folder_exists:
-                self._log("creating remote_cache_folder %s" % repr(self.remote_cache_folder))
-                self.ios.mkdir(self.remote_cache_folder)
-
-            # Create a local cache
-            with open(lhc, 'wb') as hcf:
-                hash_cache = {'version': 1}
-                pickle.dump(hash_cache, hcf, pickle.HIGHEST_PROTOCOL)
-            self._log("creating new local hash cache: version %d" %
-                      hash_cache['version'])
-
-            """
-            # Clear the marvin_content_updated flag
-            if getattr(self.parent, 'marvin_content_updated', False):
-                self._log("clearing marvin_content_updated flag")
-                setattr(self.parent, 'marvin_content_updated', False)
-            """
-
-        self.local_hash_cache = lhc
-        self.remote_hash_cache = rhc
-
-        # Purge cache orphans, but only if we're looking at entire library.
-        mdb = self.opts.gui.library_view.model().db
-        current_vl = mdb.data.get_base_restriction_name()
-
-        if cache_exists and current_vl == '':
-            hash_cache = self._purge_cached_orphans(cached_books)
-
-        return hash_cache
-
-    def _purge_cached_orphans(self, cached_books):
+    def _localize_hash_cache(self, cached_books):
         '''
-
+        Open the local hash cache, apply any new segments from the iDevice.
+        If hash caching is disabled, start with an empty cache.
+        If looking at entire library, purge orphans
         '''
         self._log_location()
 
-        # Find the orphans
-        orphans = []
-        with open(self.local_hash_cache, 'rb') as hcf:
-            hash_cache = pickle.load(hcf)
-            for key in hash_cache:
-                if key not in cached_books and key != 'version':
-                    self._log("removing %s from hash cache" % key)
-                    orphans.append(key)
+        # Confirm path to remote folder is valid store point
+        folder_exists = self.ios.exists(self.remote_cache_folder)
+        if not folder_exists:
+            self._log("creating remote_cache_folder %s" % repr(self.remote_cache_folder))
+            self.ios.mkdir(self.remote_cache_folder)
+
+        # Remove the whole-file pickled cache used by earlier versions
+        legacy_hash_cache = '/'.join([self.remote_cache_folder, self.HASH_CACHE_FS])
+        if self.ios.exists(legacy_hash_cache):
+            self._log("removing legacy hash cache %s" % repr(legacy_hash_cache))
+            self.ios.remove(legacy_hash_cache)
+
+        hash_cache = HashCache(self.ios, self.parent.resources_path, self.remote_cache_folder)
+        hash_cache.connect()
 
-        # Remove the orphans
-        for key in orphans:
-            hash_cache.pop(key)
+        if self.prefs.get('hash_caching_disabled', False):
+            self._log("hash_caching_disabled, clearing local hash cache")
+            hash_cache.disable()
+        else:
+            segments_applied = hash_cache.pull()
+            self._log("hash cache: {0} remote segments applied, {1} books in cache".format(
+                segments_applied, len(hash_cache)))
 
-        # Write updated hash_cache
-        with open(self.local_hash_cache, 'wb') as hcf:
-            pickle.dump(hash_cache, hcf, pickle.HIGHEST_PROTOCOL)
+            # Purge cache orphans, but only if we're looking at entire library.
+            mdb = self.opts.gui.library_view.model().db
+            current_vl = mdb.data.get_base_restriction_name()
+            if current_vl == '':
+                hash_cache.purge(cached_books)
 
         return hash_cache
 
@@ -4929,16 +5118,85 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             import traceback
             self._log(traceback.format_exc())
 
+    def _save_installed_books_cache(self):
+        '''
+        Save installed_books for the next session with this device
+        '''
+        if (self.installed_books is None or self.installed_books_row_state is None or
+                self.main_db_checksum is None):
+            return
+
+        self._log_location("%d books" % len(self.installed_books))
+        try:
+            InstalledBooksCache(self.parent.resources_path, self.device_id).save(
+                self._get_installed_books_cache_key(), self.installed_books,
+                self.installed_books_row_state, self.main_db_checksum)
+        except:
+            import traceback
+            self._log(traceback.format_exc())
+
     def _scan_library_books(self, library_scanner):
         '''
         Generate hashes for library epubs
+        Stale epubs are hashed in place. Large scans are fanned out in batches
+        to a pool of worker processes, with each batch's hashes applied on the
+        GUI thread as it completes. New hashes are written to the library in
+        batches of EPUB_HASH_FLUSH_SIZE.
         '''
-        def _get_hash(cid):
-            path = db.format(cid, 'epub', index_is_id=True,
-                             as_path=True, preserve_filename=True)
-            hash = self._compute_epub_hash(path)
-            os.remove(path)
-            return hash
+        def _flush_hashes():
+            '''
+            Write pending epub_hash entries to the library in a single transaction
+            '''
+            #self._log("flushing %d epub hashes" % len(pending_hashes))
+            save_epub_hashes(db, pending_hashes)
+            pending_hashes.clear()
+
+        def _hash_stale_books(stale_books):
+            '''
+            Return True if all stale_books [(cid, path), ...] were hashed
+            '''
+            batch_size = self.LIBRARY_HASH_BATCH_SIZE
+            if len(stale_books) <= batch_size:
+                # Not worth starting worker processes
+                for cid, path in stale_books:
+                    _store_hash(cid, self._compute_epub_hash(path))
+                    pb.increment()
+                    if pb.close_requested:
+                        return False
+                return True
+
+            pool_size = max(1, self.prefs.get('library_hash_workers', cpu_count()))
+            self._log("hashing %d epubs in batches of %d, %d workers" %
+                      (len(stale_books), batch_size, pool_size))
+            return run_batched_jobs('calibre_plugins.marvin_manager.epub_hash', 'hash_epubs',
+                                    [stale_books[i:i + batch_size]
+                                     for i in range(0, len(stale_books), batch_size)],
+                                    _store_batch, pool_size=pool_size,
+                                    description="Hashing library epubs",
+                                    cancel_requested=lambda: pb.close_requested)
+
+        def _store_batch(batch, hashes):
+            '''
+            Store a batch of {cid: hash} from run_batched_jobs()
+            '''
+            if hashes is None:
+                self._log("hashing batch failed, hashing in process")
+                hashes = dict([(cid, self._compute_epub_hash(path))
+                               for cid, path in batch])
+            for cid, hash in hashes.items():
+                _store_hash(cid, hash)
+            pb.set_value(pb.progressBar.value() + len(batch))
+
+        def _store_hash(cid, hash):
+            '''
+            Save hash to the uuid_map, queue it for the library's epub_hash cache
+            '''
+            uuid, mtime = stale_book_info[cid]
+            uuid_map[uuid]['hash'] = hash
+            cached_dict = {'mtime': mtime, 'hash': hash}
+            pending_hashes[cid] = json.dumps(cached_dict)
+            if len(pending_hashes) >= self.EPUB_HASH_FLUSH_SIZE:
+                _flush_hashes()
 
         pb = ProgressBar(parent=self.opts.gui, window_title="Scanning calibre library")
         pb.set_label('{:^100}'.format("Waiting for library scan to complete…"))
@@ -4986,55 +5244,19 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             library_snapshots[lib_name] = last_modified
             self.opts.prefs.set('calibre_library_snapshots', library_snapshots)
 
-        close_requested = False
-
-        all_cached_hashes = db.get_all_custom_book_data('epub_hash')
-        for k, v in all_cached_hashes.items():
-            all_cached_hashes[k] = json.loads(v)
+        # Use cached hashes where the epub hasn't changed, collect the rest
+        pending_hashes = {}
+        stale_books, stale_book_info, close_requested = find_stale_epubs(db, uuid_map, pb)
 
-        for i, uuid in enumerate(uuid_map):
+        if not close_requested:
+            self._log("%d stale library hashes" % len(stale_books))
             try:
-                cid = uuid_map[uuid]['id']
-
-                # Do we have a cached hash?
-                cached_hash = all_cached_hashes.get(cid, None)
-                if cached_hash is None:
-                    # Generate the hash, save it to local hash map
-                    #self._log("generating hash")
-                    hash = _get_hash(cid)
-                    uuid_map[uuid]['hash'] = hash
-
-                    # Cache hash to db
-                    #self._log("adding cached_hash to db")
-                    mtime = db.format_last_modified(cid, 'epub')
-                    cached_dict = {'mtime': time.mktime(mtime.timetuple()), 'hash': hash}
-                    db.add_custom_book_data(cid, 'epub_hash', json.dumps(cached_dict))
-                else:
-                    mtime = db.format_last_modified(cid, 'epub')
-                    if cached_hash['mtime'] == time.mktime(mtime.timetuple()):
-                        #self._log("fetching cached_hash from db")
-                        hash = cached_hash['hash']
-                        uuid_map[uuid]['hash'] = hash
-                    else:
-                        # Book has been modified since we generated the hash
-                        #self._log("generating new cached_hash")
-                        hash = _get_hash(cid)
-                        uuid_map[uuid]['hash'] = hash
-
-                        # Update db
-                        cached_dict = {'mtime': time.mktime(mtime.timetuple()), 'hash': hash}
-                        db.add_custom_book_data(cid, 'epub_hash', json.dumps(cached_dict))
-
-            except:
-                # Book deleted since scan
-                pass
-
-            pb.increment()
+                close_requested = not _hash_stale_books(stale_books)
+            finally:
+                # Keep whatever we hashed, even if cancelled
+                _flush_hashes()
 
-            if pb.close_requested:
-                close_requested = True
-                break
-        else:
+        if not close_requested:
             # Only build the hash map if we completed without a close request
             hash_map = library_scanner.build_hash_map()
 
@@ -5048,7 +5270,56 @@ class BookStatusDialog(SizePersistedDialog, Logger):
     def _scan_marvin_books(self, cached_books):
         '''
         Create the initial dict of installed books with hash values
+        Uncached books are run through a pipeline: transfer workers fingerprint
+        or copy books from the iDevice, feeding a bounded queue of local copies
+        to the hash workers. iDevice access is serialized with ios_lock.
+        Books that can't be copied or hashed get a unique hash from their path,
+        and are left out of the hash cache so they are retried next scan.
         '''
+        def _hash_worker():
+            while True:
+                item = copied_books.get()
+                if item is None:
+                    break
+                path, lbp = item
+                hash = None
+                try:
+                    hash = self._compute_epub_hash(lbp)
+                except:
+                    import traceback
+                    self._log(traceback.format_exc())
+                finally:
+                    if os.path.exists(lbp):
+                        os.remove(lbp)
+                results.put((path, hash))
+
+        def _transfer_worker():
+            while not stop_requested.is_set():
+                try:
+                    path = pending_books.get_nowait()
+                except Empty:
+                    break
+
+                try:
+                    size = book_stats.get(path, (None, None))[0]
+                    with ios_lock:
+                        fingerprinted, hash = self._fetch_marvin_content_hash(path, size)
+                    if fingerprinted:
+                        results.put((path, hash))
+                        continue
+
+                    with ios_lock:
+                        lbp = self._copy_marvin_book(path)
+                    if lbp is None:
+                        results.put((path, None))
+                    else:
+                        # Blocks while the hash workers are behind
+                        copied_books.put((path, lbp))
+                except:
+                    import traceback
+                    self._log(traceback.format_exc())
+                    results.put((path, None))
+
         self._log_location("%d books" % len(cached_books))
 
         # Fetch pre-existing hash cache from device, purge orphans
@@ -5064,24 +5335,81 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 
         close_requested = False
         installed_books = {}
-        for i, path in enumerate(cached_books):
-            this_book = {}
-            #pb.set_label('{:^100}'.format("%d of %d" % (i+1, total_books)))
-            this_book['hash'] = self._fetch_marvin_content_hash(path)
 
-            installed_books[path] = this_book
-            pb.increment()
+        # Books whose cached size and mtime still match don't need the pipeline
+        book_stats = self._get_marvin_book_stats(cached_books)
+        pending_books = Queue()
+        for path in cached_books:
+            cached = self.hash_cache.get(path)
+            if (cached and path in book_stats and
+                    (cached['size'], cached['mtime']) == book_stats[path]):
+                installed_books[path] = {'hash': cached['hash']}
+                pb.increment()
+            else:
+                pending_books.put(path)
+        uncached_count = pending_books.qsize()
+
+        if uncached_count and self.remote_fingerprinting:
+            # Confirm ranged reads work before trusting them
+            path = pending_books.queue[0]
+            self.remote_fingerprinting = self._verify_remote_fingerprinting(
+                path, book_stats.get(path, (None, None))[0])
+
+        if uncached_count and not pb.close_requested:
+            transfer_worker_count = max(1, self.prefs.get('scan_transfer_workers', 1))
+            hash_worker_count = max(1, self.prefs.get('scan_hash_workers', 2))
+            queue_depth = max(1, self.prefs.get('scan_queue_depth', 4))
+            self._log("pipelining %d books: %d transfer, %d hash workers, queue depth %d" %
+                      (uncached_count, transfer_worker_count, hash_worker_count, queue_depth))
+
+            copied_books = Queue(maxsize=queue_depth)
+            ios_lock = Lock()
+            results = Queue()
+            stop_requested = Event()
+
+            transfer_workers = [Thread(target=_transfer_worker) for i in range(transfer_worker_count)]
+            hash_workers = [Thread(target=_hash_worker) for i in range(hash_worker_count)]
+            for worker in transfer_workers + hash_workers:
+                worker.daemon = True
+                worker.start()
+
+            received = 0
+            while received < uncached_count:
+                try:
+                    path, hash = results.get(timeout=0.1)
+                except Empty:
+                    Application.processEvents()
+                else:
+                    if hash is None:
+                        # Don't cache the failure, and don't let failures match each other
+                        m = hashlib.md5()
+                        m.update(os.path.join(self.local_cache_folder, path))
+                        hash = m.hexdigest()
+                    else:
+                        size, mtime = book_stats.get(path, (None, None))
+                        self.hash_cache.set(path, hash, mtime, size)
+                    installed_books[path] = {'hash': hash}
+                    received += 1
+                    pb.increment()
+
+                if pb.close_requested:
+                    stop_requested.set()
+                    break
+
+            # Wind down the pipeline
+            for worker in transfer_workers:
+                worker.join()
+            for worker in hash_workers:
+                copied_books.put(None)
+            for worker in hash_workers:
+                worker.join()
 
-            if pb.close_requested:
-                close_requested = True
-                break
-        else:
-            # Store the updated hash_cache if we finished
-            with open(self.local_hash_cache, 'wb') as hcf:
-                pickle.dump(self.hash_cache, hcf, pickle.HIGHEST_PROTOCOL)
+        if pb.close_requested:
+            close_requested = True
 
-            # Push the local hash to the iDevice
-            self._update_remote_hash_cache()
+        # Push new hashes to the iDevice, including those from a cancelled scan
+        self._update_remote_hash_cache()
+        self.hash_cache.close()
 
         pb.hide()
 
@@ -5238,7 +5566,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             self.saved_selection_region = None
 
         if update_local_db and local_db_update_required:
-            self._localize_marvin_database()
+            self.main_db.invalidate()
 
         Application.processEvents()
 
@@ -5310,7 +5638,8 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                 self.tv.setSelection(rect, QItemSelectionModel.Select)
             self.saved_selection_region = None
 
-        self._localize_marvin_database()
+        # One refresh for all of the _apply_flags() updates
+        self.main_db.refresh_if_stale()
 
         Application.processEvents()
 
@@ -5578,6 +5907,9 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                 MessageBox(MessageBox.INFO, title, msg,
                            show_copy_button=False).exec_()
 
+        # One refresh for all of the updates
+        self.main_db.refresh_if_stale()
+
     def _update_device_flags(self, book_id, path, updated_flags):
         '''
         Given a set of updated flags for path, update local copies:
@@ -6126,6 +6458,9 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             if self.busy_cancel_requested:
                 break
 
+        # One refresh for all of the updates
+        self.main_db.refresh_if_stale()
+
         self._busy_status_teardown()
 
         # Launch row flasher
@@ -6178,20 +6513,41 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 
     def _update_remote_hash_cache(self):
         '''
-        Copy updated hash cache to iDevice
-        self.local_hash_cache, self.remote_hash_cache initialized
-        in _localize_hash_cache()
+        Push records added since _localize_hash_cache() to the iDevice
         '''
         self._log_location()
 
-        if self.ios.exists(str(self.remote_hash_cache)):
-            self.ios.remove(str(self.remote_hash_cache))
-
         if self.parent.prefs.get('hash_caching_disabled', False):
             self._log("hash_caching_disabled, deleting remote hash cache")
+            self.hash_cache.remove_remote()
         else:
-            # Copy local cache to iDevice
-            self.ios.copy_to_idevice(self.local_hash_cache, str(self.remote_hash_cache))
+            self.hash_cache.push()
+
+    def _verify_remote_fingerprinting(self, path, size=None):
+        '''
+        Test ranged reads on a Marvin book by reading its container.xml in place
+        Return True if it parses, otherwise books are copied for hashing
+        '''
+        self._log_location(path)
+        rbp = '/'.join(['/Documents', path])
+        rf = None
+        try:
+            if size is None:
+                size = self.ios.exists(str(rbp))['st_size']
+            rf = RemoteFile(self.ios, rbp, size)
+            zf = ZipFile(rf, 'r')
+            container = etree.fromstring(zf.read('META-INF/container.xml'))
+            if container.xpath('.//*[local-name()="rootfile"]/@full-path'):
+                return True
+            self._log("no rootfile in container.xml")
+        except:
+            import traceback
+            self._log(traceback.format_exc())
+        finally:
+            if rf is not None:
+                rf.close()
+        self._log("ranged reads unavailable, falling back to copying books")
+        return False
 
     def _wait_for_command_completion(self, command_name, update_local_db=True,
             get_response=None, timeout_override=None):
@@ -6385,9 +6741,9 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                               command_name))
                     break
 
-            # Update local copy of Marvin db
-            if update_local_db and final_code == '0':
-                self._localize_marvin_database()
+            # Whatever update_local_db says, Marvin may have changed mainDb. The local
+            # copy is refreshed before it's next read, skipped if the remote is unchanged
+            self.main_db.invalidate()
 
         else:
             self._log("~~~ execute_marvin_commands disabled in JSON ~~~")
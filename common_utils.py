@@ -8,10 +8,13 @@ __license__ = 'GPL v3'
 __copyright__ = '2013, Greg Riker <griker@hotmail.com>'
 __docformat__ = 'restructuredtext en'
 
-import cStringIO, os, re, sys
+import cPickle, cStringIO, hashlib, json, os, re, sqlite3, sys
 
-from collections import defaultdict
-from time import sleep
+from collections import defaultdict, OrderedDict
+from ctypes import byref, c_longlong
+from multiprocessing import cpu_count
+from Queue import Empty
+from time import mktime, sleep, time
 
 from calibre.constants import iswindows
 from calibre.devices.usbms.driver import debug_print
@@ -22,8 +25,12 @@ from calibre.gui2 import Application
 from calibre.gui2.dialogs.message_box import MessageBox
 from calibre.gui2.progress_indicator import ProgressIndicator
 from calibre.library import current_library_name
-from calibre.utils.config import config_dir
+from calibre.utils.config import config_dir, JSONConfig
+from calibre.utils.date import parse_date, utcfromtimestamp
+from calibre.utils.icu import lower as icu_lower
 from calibre.utils.ipc import RC
+from calibre.utils.ipc.job import ParallelJob
+from calibre.utils.ipc.server import Server
 
 from PyQt4.Qt import (Qt, QAbstractItemModel, QAction, QApplication,
                       QCheckBox, QComboBox, QDial, QDialog, QDialogButtonBox,
@@ -37,6 +44,8 @@ from PyQt4.Qt import (Qt, QAbstractItemModel, QAction, QApplication,
 from PyQt4.QtWebKit import QWebView
 from PyQt4.uic import compileUi
 
+from calibre_plugins.marvin_manager.epub_hash import compute_epub_hash
+
 # Stateful controls: (<class>,<list_name>,<get_method>,<default>,<set_method(s)>)
 # multiple set_methods are chained, i.e. the results of the first call are passed to the second
 # Currently a max of two chained CONTROL_SET methods are implemented, explicity for comboBox
@@ -57,6 +66,8 @@ CONTROL_GET = [control[2] for control in CONTROLS]
 CONTROL_DEFAULT = [control[3] for control in CONTROLS]
 CONTROL_SET = [control[4] for control in CONTROLS]
 
+NORMALIZE_PAT = re.compile(r'[\W_]+', re.UNICODE)
+
 plugin_tmpdir = 'calibre_annotations_plugin'
 
 plugin_icon_resources = {}
@@ -404,10 +415,16 @@ class ProgressBar(QDialog, Logger):
 class IndexLibrary(QThread):
     '''
     Build indexes of library:
-    {title: {'authors':…, 'id':…, 'uuid:'…}, …}
-    {uuid:  {'author's:…, 'id':…, 'title':…, 'path':…}, …}
-    {id:    {'uuid':…, 'author':…}, …}
+    {(title, author): [id, …], …} normalized, see title_author_key()
+    {uuid:  {'authors':…, 'id':…, 'title':…}, …}
+    {id:    {'authors':…, 'title':…, 'uuid':…}, …}
+    The indexes cover the whole library. vl_hash_map, vl_uuid_map and
+    find_by_title_author() restrict them to the virtual library set with
+    set_virtual_library().
+    The indexes can be saved with snapshot() and restored with load_snapshot()
     '''
+    SNAPSHOT_FS = "{0}_library_index.json"
+    SNAPSHOT_VERSION = 2
 
     def __init__(self, parent):
         QThread.__init__(self, parent)
@@ -416,10 +433,34 @@ class IndexLibrary(QThread):
         self.id_map = None
         self.hash_map = None
         self.active_virtual_library = None
+        self.virtual_library_ids = {}
+        self.vl_ids = None
+
+    @property
+    def vl_hash_map(self):
+        if self.hash_map is None or self.vl_ids is None:
+            return self.hash_map
+
+        def _filter(uuids):
+            uuids = [uuid for uuid in uuids
+                     if uuid not in self.uuid_map or
+                     self.uuid_map[uuid]['id'] in self.vl_ids]
+            return uuids or None
+        return VirtualLibraryMap(self.hash_map, _filter)
+
+    @property
+    def vl_uuid_map(self):
+        if self.vl_ids is None:
+            return self.uuid_map
+        return VirtualLibraryMap(self.uuid_map, self._filter_entry)
+
+    @classmethod
+    def snapshot_path(cls, resources_path, library_id):
+        return os.path.join(resources_path,
+                            cls.SNAPSHOT_FS.format(re.sub('\W', '_', library_id)))
 
     def run(self):
-        self.title_map = self.index_by_title()
-        self.uuid_map = self.index_by_uuid()
+        self.build_indexes()
         self.emit(self.signal)
 
     def add_to_hash_map(self, hash, uuid):
@@ -449,40 +490,295 @@ class IndexLibrary(QThread):
         self.hash_map = hash_map
         return hash_map
 
-    def index_by_title(self):
+    def build_indexes(self):
         '''
-        By default, any search restrictions or virtual libraries are applied
-        calibre.db.view:search_getting_ids()
+        Build title_author_map, uuid_map and id_map in a single walk of the library,
+        reading title, authors and uuid straight from each cached record.
+        The active virtual library is ignored, see set_virtual_library()
         '''
-        by_title = {}
+        by_id = {}
+        by_title_author = {}
+        by_uuid = {}
 
-        cids = self.cdb.search_getting_ids('formats:EPUB', '')
+        fm = self.cdb.FIELD_MAP
+        id_col = fm['id']
+        title_col = fm['title']
+        authors_col = fm['authors']
+        uuid_col = fm['uuid']
+
+        self.id_map = by_id
+        self.title_author_map = by_title_author
+        self.uuid_map = by_uuid
+
+        self.virtual_library_ids = {}
+        epub_cids = set(self.cdb.search_getting_ids('formats:EPUB', '',
+                                                    use_virtual_library=False))
+        for record in self.cdb.data.iterall():
+            cid = record[id_col]
+            if cid not in epub_cids:
+                continue
+            self._index_book(cid, record[title_col], record[authors_col], record[uuid_col])
+
+    def checksum(self):
+        '''
+        Return an md5 of the indexed books and their hashes. Unlike the library's
+        last_modified, it only changes when the indexes do
+        '''
+        return hashlib.md5(json.dumps(sorted(self._snapshot_books()))).hexdigest()
+
+    def find_by_title_author(self, title, authors, hash=None):
+        '''
+        Return the cids in the active virtual library matching title and authors,
+        ignoring case, punctuation and spacing
+        authors may be a list or a Marvin 'Author 1, Author 2' string
+        If hash is given and some duplicates' epubs match it, only those are returned
+        '''
+        cids = self.title_author_map.get(title_author_key(title, authors), [])
+        if self.vl_ids is not None:
+            cids = [cid for cid in cids if cid in self.vl_ids]
+        if hash is not None and len(cids) > 1:
+            hash_matches = [cid for cid in cids
+                            if self.uuid_map.get(self.id_map[cid]['uuid'], {}).get('hash') == hash]
+            if hash_matches:
+                cids = hash_matches
+        return cids
+
+    def load_snapshot(self, snapshot):
+        '''
+        Restore the indexes from a snapshot(), then patch the books added, changed
+        or deleted since the snapshot was taken. Adding or removing an EPUB doesn't
+        always touch a book's last_modified, so formats are compared too
+        '''
+        self.id_map = {}
+        self.title_author_map = {}
+        self.uuid_map = {}
+        for book in snapshot['books']:
+            cid, title, authors, uuid = book[:4]
+            self._index_book(cid, title, ','.join(authors), uuid)
+            if len(book) > 4:
+                self.uuid_map[uuid]['hash'] = book[4]
+
+        if snapshot['last_modified'] != self.cdb.last_modified().isoformat():
+            snapshot_last_modified = parse_date(snapshot['last_modified'])
+            fm = self.cdb.FIELD_MAP
+            id_col = fm['id']
+            last_modified_col = fm['last_modified']
+
+            current_cids = set()
+            changed_cids = set()
+            for record in self.cdb.data.iterall():
+                cid = record[id_col]
+                current_cids.add(cid)
+                if record[last_modified_col] > snapshot_last_modified:
+                    changed_cids.add(cid)
+
+            epub_cids = set(self.cdb.search_getting_ids('formats:EPUB', '',
+                                                        use_virtual_library=False))
+            self.remove_books([cid for cid in self.id_map
+                               if cid not in current_cids or cid not in epub_cids])
+            changed_cids.update([cid for cid in epub_cids if cid not in self.id_map])
+            if changed_cids:
+                self.update_books(changed_cids)
+
+        if snapshot['hash_map']:
+            self.build_hash_map()
+
+    def remove_books(self, cids):
+        '''
+        Drop deleted or changed books from the indexes, including hash_map
+        '''
         for cid in cids:
-            title = self.cdb.title(cid, index_is_id=True)
-            by_title[title] = {
-                'authors': self.cdb.authors(cid, index_is_id=True).split(','),
-                'id': cid,
-                'uuid': self.cdb.uuid(cid, index_is_id=True)
-                }
-        return by_title
-
-    def index_by_uuid(self):
+            entry = self.id_map.pop(cid, None)
+            if entry is None:
+                continue
+
+            uuid = entry['uuid']
+            uuid_entry = self.uuid_map.pop(uuid, None)
+            if (self.hash_map is not None and uuid_entry is not None and
+                    'hash' in uuid_entry):
+                uuids = self.hash_map.get(uuid_entry['hash'], [])
+                if uuid in uuids:
+                    uuids.remove(uuid)
+                if not uuids:
+                    self.hash_map.pop(uuid_entry['hash'], None)
+
+            key = title_author_key(entry['title'], entry['authors'])
+            cids = self.title_author_map.get(key, [])
+            if cid in cids:
+                cids.remove(cid)
+            if not cids:
+                self.title_author_map.pop(key, None)
+
+    def update_books(self, cids):
         '''
-        By default, any search restrictions or virtual libraries are applied
-        calibre.db.view:search_getting_ids()
+        Re-read added or edited books from the library. A book keeps its hash
+        while its cached epub_hash is current, otherwise it is left for
+        find_stale_epubs() to rehash.
+        The indexes cover the whole library, so they are patched whether or not
+        a virtual library is active. Edits may move books in or out of virtual
+        libraries, so the cached virtual library ids are dropped and the active
+        one is re-read, see set_virtual_library()
         '''
-        by_uuid = {}
+        self.virtual_library_ids = {}
+        if (self.vl_ids is not None and
+                self.cdb.data.get_base_restriction_name() == self.active_virtual_library):
+            self.set_virtual_library(self.active_virtual_library)
 
-        cids = self.cdb.search_getting_ids('formats:EPUB', '')
+        self.remove_books(cids)
         for cid in cids:
+            if not self.cdb.has_format(cid, 'EPUB', index_is_id=True):
+                continue
             uuid = self.cdb.uuid(cid, index_is_id=True)
-            by_uuid[uuid] = {
-                'authors': self.cdb.authors(cid, index_is_id=True).split(','),
-                'id': cid,
-                'title': self.cdb.title(cid, index_is_id=True),
-                }
+            self._index_book(cid,
+                             self.cdb.title(cid, index_is_id=True),
+                             self.cdb.authors(cid, index_is_id=True),
+                             uuid)
+
+            cached_hash = self.cdb.get_custom_book_data(cid, 'epub_hash')
+            if cached_hash is None:
+                continue
+            cached_hash = json.loads(cached_hash)
+            mtime = mktime(self.cdb.format_last_modified(cid, 'epub').timetuple())
+            if cached_hash['mtime'] == mtime:
+                self.uuid_map[uuid]['hash'] = cached_hash['hash']
+                if self.hash_map is not None:
+                    self.add_to_hash_map(cached_hash['hash'], uuid)
+
+    def set_virtual_library(self, vl_name):
+        '''
+        Restrict the vl_* maps to vl_name, which must be the library view's
+        current virtual library. Its ids are cached per name and definition,
+        so switching between virtual libraries doesn't reindex
+        '''
+        self.active_virtual_library = vl_name
+        if not vl_name:
+            self.vl_ids = None
+            return
+
+        vl_key = (vl_name, self.cdb.prefs.get('virtual_libraries', {}).get(vl_name))
+        if vl_key not in self.virtual_library_ids:
+            self.virtual_library_ids[vl_key] = frozenset(
+                self.cdb.search_getting_ids('formats:EPUB', ''))
+        self.vl_ids = self.virtual_library_ids[vl_key]
+
+    def snapshot(self, last_modified):
+        '''
+        Return the indexes as a JSON-serializable dict, keyed by library_id and
+        the library's last_modified when they were current
+        Books are [cid, title, authors, uuid(, hash)]
+        '''
+        return {
+            'books': self._snapshot_books(),
+            'hash_map': self.hash_map is not None,
+            'last_modified': last_modified.isoformat(),
+            'library_id': self.cdb.library_id,
+            'version': self.SNAPSHOT_VERSION
+            }
+
+    def unhashed_books(self):
+        '''
+        Return the subset of uuid_map still needing a hash
+        '''
+        return dict([(uuid, entry) for uuid, entry in self.uuid_map.items()
+                     if 'hash' not in entry])
+
+    def _filter_entry(self, entry):
+        if entry['id'] in self.vl_ids:
+            return entry
+
+    def _snapshot_books(self):
+        books = []
+        for uuid, entry in self.uuid_map.items():
+            book = [entry['id'], entry['title'], entry['authors'], uuid]
+            if 'hash' in entry:
+                book.append(entry['hash'])
+            books.append(book)
+        return books
+
+    def _index_book(self, cid, title, authors, uuid):
+        authors = (authors or '').split(',')
+        self.id_map[cid] = {
+            'authors': authors,
+            'title': title,
+            'uuid': uuid
+            }
+        self.title_author_map.setdefault(title_author_key(title, authors), []).append(cid)
+        self.uuid_map[uuid] = {
+            'authors': authors,
+            'id': cid,
+            'title': title
+            }
+
+class PreHashLibrary(QThread):
+    '''
+    Hash stale library epubs at idle priority
+    uuid_cids: [(uuid, cid), ...] to check, epub_paths: {cid: path},
+    cached_hashes: {cid: json epub_hash} as read from the library on the GUI thread.
+    Current cached hashes accumulate in self.known_hashes {uuid: hash}. New hashes
+    {cid: (uuid, mtime, hash)} are emitted in batches of FLUSH_SIZE, the remainder
+    is left in self.hashes.
+    Hashing pauses while the GUI thread is late for its heartbeat, i.e. busy
+    See MarvinManagerAction:start_library_prehash()
+    '''
+    BUSY_MS = 250
+    FLUSH_SIZE = 50
+    HEARTBEAT_MS = 100
+
+    def __init__(self, parent, library_scanner, uuid_cids, epub_paths, cached_hashes):
+        QThread.__init__(self, parent)
+        self.batch_signal = SIGNAL("library_prehash_batch")
+        self.signal = SIGNAL("library_prehash_complete")
+        self.cached_hashes = cached_hashes
+        self.db = parent.gui.current_db
+        self.epub_paths = epub_paths
+        self.hashes = {}
+        self.known_hashes = {}
+        self.library_scanner = library_scanner
+        self.stop_requested = False
+        self.uuid_cids = uuid_cids
+
+        # Ticks on the GUI thread
+        self.heartbeat = time()
+        self.heartbeat_timer = QTimer(self)
+        self.heartbeat_timer.timeout.connect(self._beat)
+        self.heartbeat_timer.start(self.HEARTBEAT_MS)
+        self.connect(self, SIGNAL("finished()"), self.heartbeat_timer.stop)
+
+    def run(self):
+        epub_stats = stat_epubs(self.epub_paths)
+        for uuid, cid in self.uuid_cids:
+            if self.stop_requested:
+                break
+            if cid not in epub_stats:
+                # Book deleted since scan
+                continue
+            path, mtime = epub_stats[cid]
+
+            # Do we have a current cached hash?
+            cached_hash = self.cached_hashes.get(cid)
+            if cached_hash is not None:
+                cached_hash = json.loads(cached_hash)
+                if cached_hash['mtime'] == mtime:
+                    self.known_hashes[uuid] = cached_hash['hash']
+                    continue
+
+            self._yield_to_gui()
+            self.hashes[cid] = (uuid, mtime, compute_epub_hash(path))
+            if len(self.hashes) >= self.FLUSH_SIZE:
+                self.emit(self.batch_signal, self.hashes)
+                self.hashes = {}
+        self.emit(self.signal)
+
+    def stop(self):
+        self.stop_requested = True
+
+    def _beat(self):
+        self.heartbeat = time()
 
-        return by_uuid
+    def _yield_to_gui(self):
+        while (not self.stop_requested and
+               (time() - self.heartbeat) * 1000 > self.BUSY_MS):
+            self.msleep(self.HEARTBEAT_MS)
 
 
 class InventoryCollections(QThread):
@@ -563,6 +859,159 @@ class RowFlasher(QThread):
 '''     Helper Classes  '''
 
 
+class CalibreMetadata(object):
+    '''
+    Memo of the calibre metadata compared with Marvin, valid for one refresh
+    prefetch() reads each field for all cids in one pass with db.new_api,
+    falling back to get_metadata() per cid. Each cid is fetched once.
+    Cover hashes are resolved once per refresh with set_cover_hash()
+    '''
+    FIELDS = ['author_sort', 'authors', 'comments', 'ondevice', 'pubdate',
+              'publisher', 'series', 'series_index', 'sort', 'tags', 'title', 'uuid']
+
+    def __init__(self, db, collections_field=None):
+        self.collections = {}
+        self.collections_field = collections_field
+        self.cover_hashes = {}
+        self.db = db
+        self.metadata = {}
+        self.on_device = {}
+
+    def __contains__(self, cid):
+        return cid in self.metadata
+
+    def get_collections(self, cid):
+        return self.collections.get(cid)
+
+    def get_cover(self, cid):
+        '''
+        Return the cover bytes for cid, or None. GUI thread only
+        '''
+        api = getattr(self.db, 'new_api', None)
+        if api is not None:
+            return api.cover(cid)
+        return self.db.cover(cid, index_is_id=True)
+
+    def get_cover_hash(self, cid):
+        return self.cover_hashes.get(cid, '0')
+
+    def get_metadata(self, cid):
+        return self.metadata.get(cid)
+
+    def get_on_device(self, cid):
+        return self.on_device.get(cid)
+
+    def prefetch(self, cids):
+        cids = [cid for cid in set(cids) if cid is not None and cid not in self.metadata]
+        if not cids:
+            return
+
+        api = getattr(self.db, 'new_api', None)
+        fields = {}
+        if api is not None:
+            field_names = list(self.FIELDS)
+            if self.collections_field:
+                field_names.append(self.collections_field)
+            try:
+                for field in field_names:
+                    fields[field] = api.all_field_for(field, cids)
+            except:
+                # Book deleted since scan
+                fields = {}
+
+        for cid in cids:
+            try:
+                if fields:
+                    self._store(cid, fields, api)
+                else:
+                    self._fetch(cid)
+            except:
+                # Book deleted since scan
+                self.metadata[cid] = None
+
+    def set_cover_hash(self, cid, cover_hash):
+        self.cover_hashes[cid] = cover_hash
+
+    def _fetch(self, cid):
+        mi = self.db.get_metadata(cid, index_is_id=True)
+        if mi.uuid == 'dummy':
+            mi = None
+        self.metadata[cid] = mi
+        if mi is not None:
+            self.on_device[cid] = getattr(mi._proxy_metadata, 'ondevice_col', None)
+            if self.collections_field:
+                self.collections[cid] = mi.get(self.collections_field)
+
+    def _store(self, cid, fields, api):
+        mi = Metadata(fields['title'][cid], list(fields['authors'][cid]))
+        mi.author_sort = fields['author_sort'][cid]
+        mi.comments = fields['comments'][cid]
+        mi.pubdate = fields['pubdate'][cid]
+        mi.publisher = fields['publisher'][cid]
+        mi.series = fields['series'][cid]
+        mi.series_index = fields['series_index'][cid]
+        mi.tags = list(fields['tags'][cid] or [])
+        mi.title_sort = fields['sort'][cid]
+        mi.uuid = fields['uuid'][cid]
+        self.metadata[cid] = mi
+        self.on_device[cid] = fields['ondevice'][cid]
+        if self.collections_field:
+            collections = fields[self.collections_field][cid]
+            if isinstance(collections, tuple):
+                collections = list(collections)
+            self.collections[cid] = collections
+
+
+class CoverHashArchive(object):
+    '''
+    Write-behind store for archived cover hashes {cid: {'cover_hash', 'cover_last_modified'}}
+    Changes are held in memory and written to the JSONConfig file by flush(),
+    once per refresh rather than once per change
+    '''
+    def __init__(self, path):
+        self.config = JSONConfig(path)
+        self.dirty = False
+        self.entries = dict(self.config)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def flush(self):
+        if not self.dirty:
+            return
+        # Replace the contents in place, then write them once
+        dict.clear(self.config)
+        dict.update(self.config, self.entries)
+        self.config.commit()
+        self.dirty = False
+
+    def get(self, key, default=None):
+        return self.entries.get(key, default)
+
+    def keys(self):
+        return self.entries.keys()
+
+    def purge(self, active_keys):
+        '''
+        Remove entries not in active_keys, return the removed keys
+        '''
+        active_keys = set(active_keys)
+        orphans = [key for key in self.entries if key not in active_keys]
+        for key in orphans:
+            del self.entries[key]
+        if orphans:
+            self.dirty = True
+        return orphans
+
+    def set(self, key, value):
+        if self.entries.get(key) != value:
+            self.entries[key] = value
+            self.dirty = True
+
+
 class CompileUI():
     '''
     Compile Qt Creator .ui files at runtime
@@ -635,6 +1084,238 @@ class CompileUI():
         return compiled_form
 
 
+class InstalledBooksCache(object):
+    '''
+    Computed installed_books for a device, pickled between sessions, keyed by UDID
+    Books are stored as plain attribute dicts, with the row state and mainDb
+    checksum they were built from. key identifies the library index they
+    were matched against.
+    See BookStatusDialog:_get_installed_books()
+    '''
+    BOOK_ATTRIBUTES = ['article_count', 'author_sort', 'authors', 'calibre_collections',
+                       'calibre_state', 'cid', 'comments', 'cover_file', 'date_added', 'date_opened',
+                       'deep_view_prepared', 'device_collections', 'flags', 'hash',
+                       'highlight_count', 'matches', 'metadata_mismatches', 'mid',
+                       'on_device', 'path', 'pin', 'progress', 'pubdate', 'series',
+                       'series_index', 'tags', 'title', 'title_sort', 'uuid',
+                       'vocabulary_count', 'word_count']
+    LOCAL_FS = "{0}_installed_books.pickle"
+    VERSION = 3
+
+    def __init__(self, resources_path, device_id):
+        self.path = os.path.join(resources_path,
+                                 self.LOCAL_FS.format(re.sub('\W', '_', device_id)))
+
+    def load(self):
+        '''
+        Return {'books', 'key', 'main_db_checksum', 'row_state'}, or None
+        '''
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'rb') as f:
+            cache = cPickle.load(f)
+        if cache.get('version') != self.VERSION:
+            return None
+
+        books = {}
+        for book_id, attributes in cache['books'].items():
+            book = Book(attributes['title'], attributes['authors'])
+            for attribute in self.BOOK_ATTRIBUTES:
+                setattr(book, attribute, attributes.get(attribute))
+            books[book_id] = book
+        cache['books'] = books
+        return cache
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def save(self, key, installed_books, row_state, main_db_checksum):
+        books = {}
+        for book_id, book in installed_books.items():
+            books[book_id] = dict([(attribute, getattr(book, attribute, None))
+                                   for attribute in self.BOOK_ATTRIBUTES])
+        cache = {
+            'books': books,
+            'key': key,
+            'main_db_checksum': main_db_checksum,
+            'row_state': row_state,
+            'version': self.VERSION
+            }
+        with open(self.path, 'wb') as f:
+            cPickle.dump(cache, f, cPickle.HIGHEST_PROTOCOL)
+
+
+class LRUCache(object):
+    '''
+    Hold the size most recently used entries
+    '''
+    def __init__(self, size):
+        self.entries = OrderedDict()
+        self.size = size
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def clear(self):
+        self.entries.clear()
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            return default
+        # Move to most recently used
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        return value
+
+    def set(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+class MainDbConnection(object):
+    '''
+    Shared read-only connection to the local copy of Marvin's mainDb
+    Opened on first use. close() before the local copy is replaced, the next
+    connect() reopens it. sqlite3 caches prepared statements by SQL text, so
+    queries should pass values as parameters.
+    Commands changing mainDb on the iDevice invalidate() the local copy, which
+    is refreshed once by refresh() before the next read or by refresh_if_stale()
+    '''
+    CACHED_STATEMENTS = 64
+
+    def __init__(self, connected_device, refresh):
+        self.conn = None
+        self.connected_device = connected_device
+        self.refresh = refresh
+        self.stale = False
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+    def connect(self):
+        self.refresh_if_stale()
+        if self.conn is None:
+            # Python 2's sqlite3 can't open 'file:...?mode=ro' URIs, refuse writes instead
+            self.conn = sqlite3.connect(self.connected_device.local_db_path,
+                                        cached_statements=self.CACHED_STATEMENTS)
+            self.conn.row_factory = sqlite3.Row
+            self.conn.execute('''PRAGMA query_only = ON''')
+        return self.conn
+
+    def invalidate(self):
+        self.stale = True
+
+    def refresh_if_stale(self):
+        if self.stale:
+            self.stale = False
+            self.refresh()
+
+
+class RemoteFile(object):
+    '''
+    Read-only, seekable file object over a file on the iDevice.
+    ZipFile only reads the EOCD record, the central directory and the members
+    it is asked for, so only those byte ranges cross the AFC link.
+    libiMobileDevice has no public seek, so we drive afc_file_seek directly.
+    '''
+    def __init__(self, ios, path, size):
+        self.bytes_read = 0
+        self.failed = False
+        self.ios = ios
+        self.path = str(path)
+        self.pos = 0
+        self.size = int(size)
+        self.handle = ios._afc_file_open(self.path, mode='rb')
+        if self.handle is None:
+            raise IOError("unable to open %s" % repr(self.path))
+        self._afc_pos = 0
+
+    @staticmethod
+    def is_supported(ios):
+        return all([hasattr(ios, attr) for attr in
+                    ['_afc_file_open', '_afc_file_read', '_afc_file_close', 'afc', 'lib']])
+
+    def close(self):
+        if self.handle is not None:
+            self.ios._afc_file_close(self.handle)
+            self.handle = None
+
+    def read(self, size=-1):
+        remaining = self.size - self.pos
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return b''
+        if self._afc_pos != self.pos:
+            error = self.ios.lib.afc_file_seek(byref(self.ios.afc), self.handle,
+                                               c_longlong(self.pos), os.SEEK_SET) & 0xFFFF
+            if error:
+                self.failed = True
+                raise IOError("afc_file_seek error %d on %s" % (error, repr(self.path)))
+        try:
+            data = self.ios._afc_file_read(self.handle, size, self.path)
+        except:
+            self.failed = True
+            raise
+
+        # Depending on the wrapper version, a str or a ctypes buffer
+        if hasattr(data, 'raw'):
+            data = data.raw
+        if not isinstance(data, bytes):
+            self.failed = True
+            raise IOError("unexpected %s from _afc_file_read on %s" %
+                          (type(data).__name__, repr(self.path)))
+        if len(data) != size:
+            self.failed = True
+            raise IOError("short read on %s" % repr(self.path))
+        self.bytes_read += size
+        self.pos += size
+        self._afc_pos = self.pos
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise IOError("invalid seek on %s" % repr(self.path))
+        self.pos = offset
+
+    def tell(self):
+        return self.pos
+
+
+class VirtualLibraryMap(object):
+    '''
+    Read-only view of an IndexLibrary map, filtered at lookup time
+    filter(value) returns the value as seen in the virtual library, or None
+    '''
+    def __init__(self, index, filter):
+        self.filter = filter
+        self.index = index
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = self.index.get(key)
+        if value is not None:
+            value = self.filter(value)
+        return default if value is None else value
+
+
 '''     Helper functions   '''
 
 def _log(msg=None):
@@ -704,6 +1385,51 @@ def existing_annotations(parent, field, return_all=False):
     return annotation_map
 
 
+def find_stale_epubs(db, uuid_map, pb=None):
+    '''
+    Assign cached epub_hash values to uuid_map[uuid]['hash'] where the epub is unchanged
+    Return ([(cid, path), ...], {cid: (uuid, mtime)}, close_requested) for the rest
+    '''
+    all_cached_hashes = db.get_all_custom_book_data('epub_hash')
+    for k, v in all_cached_hashes.items():
+        all_cached_hashes[k] = json.loads(v)
+
+    epub_stats = get_epub_stats(db)
+
+    stale_books = []
+    stale_book_info = {}
+    for uuid in uuid_map:
+        try:
+            cid = uuid_map[uuid]['id']
+            if epub_stats is not None:
+                path, mtime = epub_stats[cid]
+            else:
+                path = None
+                mtime = mktime(db.format_last_modified(cid, 'epub').timetuple())
+
+            # Do we have a current cached hash?
+            cached_hash = all_cached_hashes.get(cid, None)
+            if cached_hash is not None and cached_hash['mtime'] == mtime:
+                uuid_map[uuid]['hash'] = cached_hash['hash']
+                if pb:
+                    pb.increment()
+            else:
+                # Hash the library's copy in place, read-only
+                if path is None:
+                    path = db.format_abspath(cid, 'EPUB', index_is_id=True)
+                stale_books.append((cid, path))
+                stale_book_info[cid] = (uuid, mtime)
+        except:
+            # Book deleted since scan
+            if pb:
+                pb.increment()
+
+        if pb and pb.close_requested:
+            return stale_books, stale_book_info, True
+
+    return stale_books, stale_book_info, False
+
+
 def get_cc_mapping(cc_name, element, default=None):
     '''
     Return the element mapped to cc_name in prefs
@@ -724,6 +1450,60 @@ def get_cc_mapping(cc_name, element, default=None):
     return ans
 
 
+def get_device_id(ios):
+    '''
+    Return a stable identifier for the mounted iDevice, its UDID or serial
+    number, falling back to the user-editable device_name
+    '''
+    get_device_info = getattr(ios, 'get_device_info', None)
+    if get_device_info is not None:
+        try:
+            device_info = get_device_info() or {}
+            for key in ['UniqueDeviceID', 'SerialNumber']:
+                if device_info.get(key):
+                    return device_info[key]
+        except:
+            import traceback
+            _log(traceback.format_exc())
+    return ios.device_name
+
+
+def get_epub_paths(db):
+    '''
+    Return {cid: path} for all library epubs from one query.
+    Return None if the library db can't be queried directly
+    '''
+    epub_paths = {}
+    try:
+        rows = db.conn.get('''SELECT
+                               data.book,
+                               books.path,
+                               data.name
+                              FROM data
+                              JOIN books ON books.id = data.book
+                              WHERE data.format = 'EPUB'
+                           ''')
+    except:
+        import traceback
+        _log(traceback.format_exc())
+        return None
+
+    for cid, book_path, name in rows:
+        epub_paths[cid] = os.path.join(db.library_path, book_path, name + '.epub')
+    return epub_paths
+
+
+def get_epub_stats(db):
+    '''
+    Return {cid: (path, mtime)} for all library epubs, see stat_epubs().
+    Return None if the library db can't be queried directly
+    '''
+    epub_paths = get_epub_paths(db)
+    if epub_paths is None:
+        return None
+    return stat_epubs(epub_paths)
+
+
 def get_icon(icon_name):
     '''
     Retrieve a QIcon for the named image from the zip file if it exists,
@@ -1081,6 +1861,68 @@ def restore_state(ui, prefs, restore_position=False):
                     _log("maximum of two chained methods")
 
 
+def run_batched_jobs(module, func, batches, on_result, pool_size=None, args=(),
+                     description='', cancel_requested=None):
+    '''
+    Run module.func(batch, *args) for each of batches in a pool of calibre worker
+    processes, calling on_result(batch, result) on the GUI thread as each job
+    finishes. result is None if the job failed.
+    Return False if cancel_requested() ended the run early
+    '''
+    server = Server(pool_size=pool_size or cpu_count())
+    pending_batches = {}
+    for batch in batches:
+        job = ParallelJob('arbitrary', description, None,
+                          args=[module, func, (batch,) + tuple(args)])
+        server.add_job(job)
+        pending_batches[job] = batch
+
+    try:
+        while pending_batches:
+            if cancel_requested is not None and cancel_requested():
+                return False
+            try:
+                job = server.changed_jobs_queue.get(timeout=0.1)
+            except Empty:
+                Application.processEvents()
+                continue
+
+            # Jobs also change when they produce notifications
+            job.update()
+            if not job.is_finished or job not in pending_batches:
+                continue
+
+            batch = pending_batches.pop(job)
+            result = None
+            if job.failed:
+                _log("%s batch failed" % func)
+                _log(job.details)
+            else:
+                result = job.result
+            on_result(batch, result)
+    finally:
+        server.close()
+    return True
+
+
+def save_epub_hashes(db, epub_hashes):
+    '''
+    Write {cid: json.dumps({'mtime':…, 'hash':…}), …} to the library's
+    epub_hash cache in a single transaction
+    '''
+    if not epub_hashes:
+        return
+    if hasattr(db, 'add_multiple_custom_book_data'):
+        db.add_multiple_custom_book_data('epub_hash', epub_hashes)
+    else:
+        for cid, val in epub_hashes.items():
+            try:
+                db.add_custom_book_data(cid, 'epub_hash', val)
+            except:
+                # Book deleted since scan
+                pass
+
+
 def save_state(ui, prefs, save_position=False):
     def _save_ui_position(ui, owner):
         prefs.set('%s_last_x' % owner, ui.pos().x())
@@ -1129,6 +1971,36 @@ def set_plugin_icon_resources(name, resources):
     plugin_icon_resources = resources
 
 
+def stat_epubs(epub_paths):
+    '''
+    Return {cid: (path, mtime)} for the epubs in {cid: path} still on disk,
+    with mtime matching what format_last_modified() would report.
+    Reads only the filesystem, so safe off the GUI thread
+    '''
+    epub_stats = {}
+    for cid, path in epub_paths.items():
+        try:
+            mtime = utcfromtimestamp(os.stat(path).st_mtime)
+        except OSError:
+            continue
+        epub_stats[cid] = (path, mktime(mtime.timetuple()))
+    return epub_stats
+
+
+def title_author_key(title, authors):
+    '''
+    Return a (title, author) key ignoring case, punctuation and spacing
+    authors may be a list or a Marvin 'Author 1, Author 2' string. calibre author
+    lists substitute '|' for commas within names, which normalizes away.
+    '''
+    def _normalize(s):
+        return icu_lower(' '.join(NORMALIZE_PAT.sub(' ', s or '').split()))
+
+    if not isinstance(authors, basestring):
+        authors = ' '.join(authors)
+    return (_normalize(title), _normalize(authors))
+
+
 def updateCalibreGUIView():
     '''
     Refresh the GUI view
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2013, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+'''
+calibre cover hashes, comparable with the CalibreCoverHash the driver writes
+to mainDb. hash_covers() runs in worker processes via run_batched_jobs().
+'''
+
+import hashlib
+
+from calibre.utils.magick.draw import thumbnail
+
+
+def compute_cover_hash(cover_data, height):
+    '''
+    Hash a thumbnail of cover_data sized to height, the same process used by
+    the driver when sending books
+    '''
+    sized_thumb = thumbnail(cover_data, height, height)
+    return hashlib.md5(sized_thumb[2]).hexdigest()
+
+
+def hash_covers(covers, height):
+    '''
+    Worker process entry point, see BookStatusDialog:_hash_stale_covers()
+    covers: [(cid, path), ...], paths are library cover files
+    Returns {cid: hash, ...}, hash is None if the cover couldn't be thumbnailed
+    '''
+    hashes = {}
+    for cid, path in covers:
+        try:
+            with open(path, 'rb') as f:
+                hashes[cid] = compute_cover_hash(f.read(), height)
+        except:
+            hashes[cid] = None
+    return hashes
@@ -8,7 +8,7 @@ __license__ = 'GPL v3'
 __copyright__ = '2010, Gregory Riker'
 __docformat__ = 'restructuredtext en'
 
-import os, sqlite3, sys
+import os, sys
 from functools import partial
 
 from calibre import strftime
@@ -59,7 +59,7 @@ class MetadataComparisonDialog(SizePersistedDialog, Ui_Dialog, Logger):
     def esc(self, *args):
         self.close()
 
-    def initialize(self, parent, book_id, cid, installed_book, enable_metadata_updates, marvin_db_path):
+    def initialize(self, parent, book_id, cid, installed_book, enable_metadata_updates, main_db):
         '''
         __init__ is called on SizePersistedDialog()
         shared attributes of interest:
@@ -81,7 +81,7 @@ class MetadataComparisonDialog(SizePersistedDialog, Ui_Dialog, Logger):
         self.cid = cid
         self.connected_device = parent.opts.gui.device_manager.device
         self.installed_book = installed_book
-        self.marvin_db_path = marvin_db_path
+        self.main_db = main_db
         self.opts = parent.opts
         self.parent = parent
         self.stored_command = None
@@ -209,17 +209,15 @@ class MetadataComparisonDialog(SizePersistedDialog, Ui_Dialog, Logger):
             Retrieve LargeCoverJpg from cache
             '''
             self._log_location()
-            con = sqlite3.connect(self.marvin_db_path)
+            con = self.main_db.connect()
             with con:
-                con.row_factory = sqlite3.Row
-
                 # Fetch Hash from mainDb
                 cover_cur = con.cursor()
                 cover_cur.execute('''SELECT
                                       Hash
                                      FROM Books
-                                     WHERE ID = '{0}'
-                                  '''.format(self.book_id))
+                                     WHERE ID = ?
+                                  ''', (self.book_id,))
                 row = cover_cur.fetchone()
 
             book_hash = row[b'Hash']
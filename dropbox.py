@@ -103,13 +103,26 @@ class PullDropboxUpdates(Logger):
         uuid = book.attrib['uuid']
         title = book.attrib['title']
         authors = book.attrib['author'].split(', ')
-        if uuid in self.parent.library_scanner.uuid_map:
-            cid = self.parent.library_scanner.uuid_map[uuid]['id']
+        library_scanner = self.parent.library_scanner
+        uuid_map = library_scanner.vl_uuid_map
+
+        # Narrow duplicates with the Marvin content hash, if the book has been scanned
+        hash = None
+        if self.parent.installed_books:
+            for installed_book in self.parent.installed_books.values():
+                if installed_book.uuid == uuid:
+                    hash = installed_book.hash
+                    break
+
+        title_author_matches = library_scanner.find_by_title_author(title, authors, hash=hash)
+        if uuid in uuid_map:
+            cid = uuid_map[uuid]['id']
             self._log("UUID match: %d" % cid)
-        elif title in self.parent.library_scanner.title_map and \
-            self.parent.library_scanner.title_map[title]['authors'] == authors:
-            cid = self.parent.library_scanner.title_map[title]['id']
+        elif title_author_matches:
+            cid = title_author_matches[0]
             self._log("Title/Author match: %d" % cid)
+            if len(title_author_matches) > 1:
+                self._log("ambiguous Title/Author matches %s" % title_author_matches)
         else:
             self._log("No match")
         return cid
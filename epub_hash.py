@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2013, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+'''
+Content hashing for epubs, shared by the GUI and by worker processes.
+Keep this module free of Qt and GUI imports, as it is imported by
+calibre's 'arbitrary' ipc worker.
+'''
+
+import hashlib
+
+from lxml import etree
+
+from calibre.utils.zipfile import ZipFile
+
+
+def compute_epub_hash(zipfile, log=None):
+    '''
+    Generate a hash of all text and css files in epub
+    zipfile may be a path or a seekable file object (RemoteFile)
+    Pass log to trace the hashed members
+    '''
+    def _url_decode(s):
+        subs = {
+                '%20': ' ',
+                '%21': '!',
+                '%22': '"',
+                '%23': '#',
+                '%25': '%'
+               }
+        for k, v in subs.iteritems():
+            s = s.replace(k, v)
+        return s
+
+    # Find the OPF file in the zipped ePub, extract a list of text files
+    try:
+        zf = ZipFile(zipfile, 'r')
+        container = etree.fromstring(zf.read('META-INF/container.xml'))
+        opf_tree = etree.fromstring(zf.read(container.xpath('.//*[local-name()="rootfile"]')[0].get('full-path')))
+
+        text_hrefs = []
+        manifest = opf_tree.xpath('.//*[local-name()="manifest"]')[0]
+        for item in manifest.iterchildren():
+            mt = item.get('media-type')
+            if mt in ['application/xhtml+xml', 'text/css']:
+                thr = item.get('href').split('/')[-1]
+                text_hrefs.append(_url_decode(thr))
+        zfi = zf.infolist()
+        zf.close()
+    except:
+        if log:
+            import traceback
+            log(traceback.format_exc())
+        return None
+
+    if log:
+        log("{:-^80}".format(" text_hrefs[] "))
+        for th in text_hrefs:
+            log(th)
+        log("{:-^80}".format(""))
+
+    m = hashlib.md5()
+    for zi in zfi:
+        base = zi.filename.split('/')[-1]
+        if log:
+            log("evaluating %s" % repr(base))
+
+        if base in text_hrefs:
+            m.update(zi.filename)
+            m.update(str(zi.file_size))
+            if log:
+                log(" adding filename %s" % (zi.filename))
+                log(" adding file_size %s" % (zi.file_size))
+
+    if log:
+        log("computed hexdigest: %s" % m.hexdigest())
+
+    return m.hexdigest()
+
+
+def hash_epubs(books):
+    '''
+    Worker process entry point, see BookStatusDialog:_scan_library_books()
+    books: [(cid, path), ...], paths are library files opened read-only in place
+    Returns {cid: hash, ...}
+    '''
+    hashes = {}
+    for cid, path in books:
+        hashes[cid] = compute_epub_hash(path)
+    return hashes
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2013, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import json, os, re, sqlite3, time, uuid
+
+from calibre.ptempfile import PersistentTemporaryFile
+
+from calibre_plugins.marvin_manager.common_utils import Logger, get_device_id
+
+
+class HashCache(Logger):
+    """
+    Marvin content hashes {path: {'hash', 'mtime', 'size'}}
+    Stored locally in a per-device SQLite db keyed by UDID, mirrored to the iDevice
+    as a folder of journal segments. Each push writes one segment holding only the records
+    changed since the last push, each pull applies only segments not yet seen.
+    """
+    COMPACT_THRESHOLD = 32
+    LOCAL_FS = "{0}_content_hashes.db"
+    REMOTE_FOLDER = "content_hashes"
+    SEGMENT_EXT = ".jsonl"
+    version = 1
+
+    def __init__(self, ios, resources_path, remote_cache_folder):
+        self.conn = None
+        self.disabled = False
+        self.entries = {}
+        self.ios = ios
+        self.needs_snapshot = False
+        self.pending = []
+        self.remote_folder = '/'.join([remote_cache_folder, self.REMOTE_FOLDER])
+        self.path = self.local_path(resources_path, get_device_id(ios))
+
+    @classmethod
+    def local_path(cls, resources_path, device_id):
+        return os.path.join(resources_path,
+                            cls.LOCAL_FS.format(re.sub('\W', '_', device_id)))
+
+    def __contains__(self, path):
+        return path in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        '''
+        Empty the local store and forget applied segments
+        '''
+        self.conn.execute('''DELETE FROM hashes''')
+        self.conn.execute('''DELETE FROM segments''')
+        self.conn.commit()
+        self.entries = {}
+        self.pending = []
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+    def connect(self):
+        self.conn = sqlite3.connect(self.path)
+        self.conn.row_factory = sqlite3.Row
+        if self.get_user_version() != self.version:
+            self.conn.executescript('''
+                DROP TABLE IF EXISTS hashes;
+                DROP TABLE IF EXISTS segments;
+                ''')
+            self.set_user_version(self.version)
+
+        # size and mtime are untyped so they round-trip exactly as reported by ios
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS hashes
+                (
+                path TEXT PRIMARY KEY,
+                hash TEXT,
+                mtime,
+                size
+                );
+            CREATE TABLE IF NOT EXISTS segments
+                (
+                name TEXT PRIMARY KEY
+                );
+            ''')
+        self.conn.commit()
+
+        self.entries = {}
+        for row in self.conn.execute('''SELECT path, hash, mtime, size FROM hashes'''):
+            self.entries[row[b'path']] = {'hash': row[b'hash'],
+                                          'mtime': row[b'mtime'],
+                                          'size': row[b'size']}
+        self._log_location("%d hashes in local cache" % len(self.entries))
+        return self.conn
+
+    def delete(self, path):
+        if path in self.entries:
+            del self.entries[path]
+            if self.disabled:
+                return
+            self.conn.execute('''DELETE FROM hashes WHERE path = ?''', (path,))
+            self.pending.append({'op': 'del', 'path': path})
+
+    def disable(self):
+        '''
+        Empty the local store and stop writing to it, for hash_caching_disabled
+        Entries set afterwards are held in memory only
+        '''
+        self.clear()
+        self.disabled = True
+
+    def get(self, path, default=None):
+        return self.entries.get(path, default)
+
+    def get_user_version(self):
+        cur = self.conn.cursor()
+        cur.execute('''PRAGMA user_version''')
+        user_version = cur.fetchone()[0]
+        return user_version
+
+    def pull(self):
+        '''
+        Apply remote segments we haven't seen, in name (timestamp) order
+        Return the number of segments applied
+        '''
+        self._log_location()
+        remote_segments = self._list_remote_segments()
+        if remote_segments is None:
+            # No remote folder
+            self.needs_snapshot = bool(self.entries)
+            return 0
+
+        applied = set([row[b'name'] for row in
+                       self.conn.execute('''SELECT name FROM segments''')])
+        if self.entries and not remote_segments:
+            # Remote cache was deleted, reseed it on the next push
+            self.needs_snapshot = True
+
+        new_segments = sorted(set(remote_segments) - applied)
+        for name in new_segments:
+            content = self.ios.read('/'.join([self.remote_folder, name]), mode='rb')
+            records = [json.loads(line) for line in bytes(content).splitlines() if line.strip()]
+            self._log("applying %s: %d records" % (name, len(records)))
+            self._apply(records)
+            self.conn.execute('''INSERT OR REPLACE INTO segments (name) VALUES (?)''', (name,))
+        self.conn.commit()
+        return len(new_segments)
+
+    def purge(self, active_paths):
+        '''
+        Remove entries for books no longer in Marvin
+        '''
+        active_paths = set(active_paths)
+        orphans = [path for path in self.entries if path not in active_paths]
+        for path in orphans:
+            self._log("removing %s from hash cache" % path)
+            self.delete(path)
+        self.conn.commit()
+        return len(orphans)
+
+    def push(self):
+        '''
+        Write pending records to the iDevice as a new segment, compacting
+        the remote folder into a snapshot once it holds too many segments
+        '''
+        self._log_location("%d pending records" % len(self.pending))
+        self.conn.commit()
+
+        remote_segments = self._list_remote_segments()
+        if remote_segments is None:
+            self._log("creating remote hash cache folder %s" % repr(self.remote_folder))
+            self.ios.mkdir(self.remote_folder)
+            remote_segments = []
+
+        if (self.needs_snapshot or
+                len(remote_segments) + 1 > self.COMPACT_THRESHOLD):
+            self._write_snapshot(remote_segments)
+        elif self.pending:
+            name = self._write_segment(self.pending)
+            self.conn.execute('''INSERT OR REPLACE INTO segments (name) VALUES (?)''', (name,))
+            self.conn.commit()
+        self.pending = []
+
+    def remove_remote(self):
+        '''
+        Delete all remote segments
+        '''
+        self._log_location()
+        remote_segments = self._list_remote_segments()
+        for name in remote_segments or []:
+            self.ios.remove('/'.join([self.remote_folder, name]))
+        self.conn.execute('''DELETE FROM segments''')
+        self.conn.commit()
+
+    def set(self, path, hash, mtime, size):
+        entry = {'hash': hash, 'mtime': mtime, 'size': size}
+        if self.entries.get(path) == entry:
+            return
+        self.entries[path] = entry
+        if self.disabled:
+            return
+        self.conn.execute('''INSERT OR REPLACE INTO hashes (path, hash, mtime, size)
+                             VALUES (?, ?, ?, ?)''', (path, hash, mtime, size))
+        record = {'op': 'set', 'path': path}
+        record.update(entry)
+        self.pending.append(record)
+
+    def set_user_version(self, db_version):
+        self.conn.execute('''PRAGMA user_version = {0}'''.format(db_version))
+
+    # ~~~~~~~~~~~~~ Helpers ~~~~~~~~~~~~~~~~~~
+
+    def _apply(self, records):
+        for record in records:
+            op = record.get('op')
+            if op == 'snapshot':
+                self.conn.execute('''DELETE FROM hashes''')
+                self.entries = {}
+            elif op == 'set':
+                path = record['path']
+                self.entries[path] = {'hash': record['hash'],
+                                      'mtime': record['mtime'],
+                                      'size': record['size']}
+                self.conn.execute('''INSERT OR REPLACE INTO hashes (path, hash, mtime, size)
+                                     VALUES (?, ?, ?, ?)''',
+                                  (path, record['hash'], record['mtime'], record['size']))
+            elif op == 'del':
+                self.entries.pop(record['path'], None)
+                self.conn.execute('''DELETE FROM hashes WHERE path = ?''', (record['path'],))
+
+    def _list_remote_segments(self):
+        '''
+        Return segment names in the remote folder, or None if it doesn't exist
+        '''
+        if not self.ios.exists(str(self.remote_folder)):
+            return None
+        listing = self.ios.listdir(str(self.remote_folder), get_stats=False)
+        names = [name.split('/')[-1] for name in listing]
+        return [name for name in names if name.endswith(self.SEGMENT_EXT)]
+
+    def _write_segment(self, records):
+        '''
+        Copy records to a uniquely named remote segment, return its name
+        Names sort by creation time, the suffix keeps concurrent writers apart
+        '''
+        name = "{0:015d}-{1}{2}".format(int(time.time() * 1000),
+                                         uuid.uuid4().hex[:8], self.SEGMENT_EXT)
+        content = '\n'.join([json.dumps(record) for record in records])
+        pt = PersistentTemporaryFile(self.SEGMENT_EXT)
+        pt.write(content.encode('utf-8'))
+        pt.close()
+        try:
+            self.ios.copy_to_idevice(pt.name, str('/'.join([self.remote_folder, name])))
+        finally:
+            os.remove(pt.name)
+        self._log("wrote %s: %d records" % (name, len(records)))
+        return name
+
+    def _write_snapshot(self, remote_segments):
+        '''
+        Replace all remote segments with a single snapshot of the local store
+        '''
+        self._log_location("compacting %d segments" % len(remote_segments))
+        records = [{'op': 'snapshot'}]
+        for path, entry in self.entries.items():
+            record = {'op': 'set', 'path': path}
+            record.update(entry)
+            records.append(record)
+        name = self._write_segment(records)
+        for old_name in remote_segments:
+            self.ios.remove('/'.join([self.remote_folder, old_name]))
+        self.conn.execute('''DELETE FROM segments''')
+        self.conn.execute('''INSERT INTO segments (name) VALUES (?)''', (name,))
+        self.conn.commit()
+        self.needs_snapshot = False